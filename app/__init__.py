@@ -8,15 +8,22 @@ from flask.ext.script import Manager, Command, Option
 from flask.ext.migrate import Migrate, MigrateCommand
 from flask.ext.moment import Moment
 
-from flask.ext.appbuilder import SQLA, AppBuilder
+from flask.ext.appbuilder import AppBuilder
 from flask.ext.appbuilder.baseviews import BaseView, expose
 
 from akismet import Akismet
 
+from replicas import RoutingSQLA
+from pool import configure_pool, dispose_engines
+from sessions import LazySessionInterface
+
 from dirtools import Dir
 import shutil
 import os
+import tempfile
 import subprocess
+import datetime
+import time
 
 logging.basicConfig(format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
 logging.getLogger().setLevel(logging.DEBUG)
@@ -64,8 +71,23 @@ class AssetDirTree(object):
         dst_dirtree_relpath = os.path.join(dst, uniq)
         dst_dirtree_abspath = os.path.join(static_folder, dst_dirtree_relpath)
 
+        # The tree is served as immutable (see ``static_files``), so it must
+        # never be seen half-copied: it is copied next to its destination,
+        # then renamed, which is atomic.
         if not os.path.exists(dst_dirtree_abspath):
-            shutil.copytree(abs_src, dst_dirtree_abspath)
+            if not os.path.exists(abs_dst):
+                os.makedirs(abs_dst)
+            tmp_abspath = tempfile.mkdtemp(prefix='.' + uniq + '-', dir=abs_dst)
+            tmp_tree = os.path.join(tmp_abspath, uniq)
+            try:
+                shutil.copytree(abs_src, tmp_tree)
+                os.rename(tmp_tree, dst_dirtree_abspath)
+            except OSError:
+                # Another process has renamed its copy first
+                if not os.path.exists(dst_dirtree_abspath):
+                    raise
+            finally:
+                shutil.rmtree(tmp_abspath, ignore_errors=True)
 
         self.dst_url = dst_dirtree_relpath
 
@@ -89,14 +111,78 @@ class AppRun(Command):
                 port=app.config['PORT'],
                 debug=app.config['DEBUG'])
 
+class BackfillCommentCounts(Command):
+    """Recounts the visible comments of all entries"""
+    # Needed only for rows that existed before ``Entry.comment_count``
+    # was added. After that, the counts are maintained automatically.
+    def run(self):
+        from app.models import update_comment_counts
+        update_comment_counts(db.session)
+        db.session.commit()
+
+class LiveTick(Command):
+    """Keeps ``Entry.is_live`` up to date, waking up at every
+    ``since``/``until`` transition (and at least every ``interval``
+    seconds, to notice entries written in the meantime)"""
+    option_list = (
+        Option('--interval', type=int, default=60),
+        Option('--once', action='store_true', default=False),
+    )
+
+    def run(self, interval, once):
+        from app.models import refresh_live_flags
+        from app.query import next_transition
+        while True:
+            now = datetime.datetime.utcnow()
+            flipped = refresh_live_flags(db.session, now)
+            db.session.commit()
+            if flipped:
+                logging.info("Flipped the is_live flag of %s entries", flipped)
+            if once:
+                return
+            transition = next_transition(now)
+            db.session.commit()
+            delay = interval
+            if transition is not None:
+                # An entry disappears right *after* its ``until``
+                delay = min(delay, (transition - now).total_seconds() + 1)
+            time.sleep(max(delay, 1))
+
+class PurgeCache(Command):
+    """Asks the reverse proxy to drop the responses tagged with the given
+    surrogate keys (see ``purge``), e.g. ``config`` to drop everything"""
+    option_list = (
+        Option('keys', nargs='+', metavar='KEY'),
+    )
+
+    def run(self, keys):
+        from app.purge import purge
+        if not app.config['PURGE_URL']:
+            logging.error("PURGE_URL is not configured")
+            return 1
+        return 0 if purge(keys) else 1
+
+class CompressStatic(Command):
+    """Builds the asset bundles and precompresses the static files
+    whose path contains a hash (see ``static_files``)"""
+    def run(self):
+        from app.static_files import compress_static
+        written = compress_static()
+        logging.info("Wrote %s compressed static files", written)
+
 def configure_manager(app):
     manager = Manager(app)
     manager.add_command('db', MigrateCommand)
     manager.add_command('run', AppRun)
+    manager.add_command('backfill_comment_counts', BackfillCommentCounts)
+    manager.add_command('live_tick', LiveTick)
+    manager.add_command('purge_cache', PurgeCache)
+    manager.add_command('compress_static', CompressStatic)
     return manager
 
 def configure_db(app):
-    db = SQLA(app)
+    configure_pool(app)
+    db = RoutingSQLA(app)
     app.db = db
     return db
 
@@ -175,6 +261,7 @@ def configure_akismet(app):
 
 app = Flask(__name__)
 app.config.from_object('config')
+app.session_interface = LazySessionInterface()
 db = configure_db(app)
 appbuilder = AppBuilder(app, db.session, indexview=NewIndexView)
 manager = configure_manager(app)
@@ -197,9 +284,22 @@ file_uploads = Blueprint('file_uploads', __name__,
 
 app.register_blueprint(file_uploads)
 
-from app import models, views, routes, rest_api
+# ``instrumentation`` and ``profiler`` first, so that they cover the whole request
+from app import instrumentation, profiler, models, views, routes, rest_api, purge, \
+    static_files
 
 # Initialize the app with good defaults, if the
 # database is stil virgin.
 import initialize
 initialize.initialize()
+
+# Don't share the connections opened so far with the workers
+# of a prefork server (see ``pool``)
+db.session.remove()
+dispose_engines(db, app)
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    pass
+else:
+    postfork(lambda: dispose_engines(db, app))
@@ -0,0 +1,69 @@
+import collections
+import datetime
+import threading
+
+
+class Cache(object):
+    """A small in-process cache whose items can expire at a given time.
+
+    It doesn't know when the data behind an item changes. Keys should
+    include the version stamps of that data (see ``models.VersionStamp``),
+    so that a change makes the old items unreachable. When the cache grows
+    beyond ``max_size`` items, the expired items are dropped, then the
+    least recently used ones."""
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        # From the least to the most recently used
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None:
+                if now is None:
+                    now = datetime.datetime.utcnow()
+                if expires <= now:
+                    return None
+            self._items[key] = item
+            return value
+
+    def set(self, key, value, expires=None):
+        """Stores ``value`` until ``expires`` (a naive UTC ``datetime``),
+        or forever if ``expires`` is ``None``."""
+        with self._lock:
+            self._items.pop(key, None)
+            if len(self._items) >= self.max_size:
+                self._evict()
+            self._items[key] = (value, expires)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def _evict(self):
+        now = datetime.datetime.utcnow()
+        for key, (value, expires) in self._items.items():
+            if expires is not None and expires <= now:
+                del self._items[key]
+        while len(self._items) >= self.max_size:
+            self._items.popitem(last=False)
+
+
+# Rendered HTML fragments shared by all requests
+# (the sidebar and the navbar, see ``routes.SiteView``)
+fragments = Cache()
+
+# Serialized Atom feeds (see ``routes.CachedFeed``)
+feeds = Cache(max_size=100)
+
+# Whole public pages (see ``page_cache``)
+pages = Cache(max_size=2000)
+
+# Pages of search results (see ``routes.SiteView.search_results_entries``)
+searches = Cache(max_size=500)
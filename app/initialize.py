@@ -72,6 +72,19 @@ def default_categories():
                             contact_category])
         db.session.commit()
 
+def default_version_stamps():
+    # Almost every write bumps some of these stamps. Creating them in
+    # advance makes each bump a plain ``UPDATE`` (see ``bump_version``).
+    try:
+        existing = [name for (name,) in db.session.query(VersionStamp.name)]
+        db.session.add_all([VersionStamp(name=name, version=0)
+                            for name in VERSION_STAMPS
+                            if name not in existing])
+        db.session.commit()
+    except:
+        db.session.rollback()
+
 def initialize():
+    default_version_stamps()
     default_blog_config()
     default_categories()
@@ -0,0 +1,100 @@
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app, appbuilder
+
+import json
+import logging
+import time
+
+# Every SQL statement is timed. During a request, the number of
+# statements, the total time spent in the database and the slowest
+# statements are collected in ``g.sql_timing``. Admins get them in a
+# ``Server-Timing`` header (shown by the network panel of the browser),
+# and statements slower than ``SLOW_QUERY_THRESHOLD`` are logged to the
+# ``'slow_queries'`` logger, one JSON object per line. The values of the
+# parameters are never logged, only their names and types.
+
+slow_query_log = logging.getLogger('slow_queries')
+if app.config['SLOW_QUERY_LOG_FILE']:
+    handler = logging.FileHandler(app.config['SLOW_QUERY_LOG_FILE'])
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    slow_query_log.addHandler(handler)
+
+class SqlTiming(object):
+    def __init__(self, keep):
+        self.count = 0
+        self.total = 0.0
+        self.keep = keep
+        # ``(duration, statement)`` pairs, the slowest first
+        self.slowest = []
+
+    def record(self, duration, statement):
+        self.count += 1
+        self.total += duration
+        if self.keep:
+            self.slowest.append((duration, statement))
+            self.slowest.sort(reverse=True)
+            del self.slowest[self.keep:]
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_timer(conn, cursor, statement, parameters, context, executemany):
+    duration = time.time() - conn.info['query_start'].pop()
+    in_request = has_request_context()
+    if in_request and hasattr(g, 'sql_timing'):
+        g.sql_timing.record(duration, statement)
+    if duration >= app.config['SLOW_QUERY_THRESHOLD']:
+        log_slow_query(duration, statement, parameters, in_request)
+
+def redact(parameters):
+    """The names (or positions) and types of the parameters"""
+    if isinstance(parameters, dict):
+        return dict((name, type(value).__name__)
+                    for (name, value) in parameters.items())
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+def log_slow_query(duration, statement, parameters, in_request):
+    record = dict(duration_ms=round(duration * 1000, 1),
+                  statement=statement,
+                  parameters=redact(parameters))
+    if in_request:
+        record.update(method=request.method,
+                      endpoint=request.endpoint,
+                      path=request.path)
+    slow_query_log.warning(json.dumps(record))
+
+def is_admin():
+    user = getattr(g, 'user', None)
+    return user is not None and user.is_authenticated() and \
+        user.role.name == appbuilder.sm.auth_role_admin
+
+def server_timing_value(description):
+    # Quoted strings can't contain quotes or backslashes
+    description = ' '.join(description.split())[:60]
+    return '"{}"'.format(description.replace('\\', '').replace('"', "'"))
+
+@app.before_request
+def start_sql_timing():
+    g.request_start = time.time()
+    g.sql_timing = SqlTiming(app.config['SERVER_TIMING_SLOWEST'])
+
+@app.after_request
+def add_server_timing_header(response):
+    timing = getattr(g, 'sql_timing', None)
+    if timing is None or not is_admin():
+        return response
+    metrics = ['app;dur={:.1f}'.format((time.time() - g.request_start) * 1000),
+               'db;dur={:.1f};desc="{} queries"'.format(timing.total * 1000,
+                                                        timing.count)]
+    for i, (duration, statement) in enumerate(timing.slowest):
+        metrics.append('sql{};dur={:.1f};desc={}'.format(
+            i + 1, duration * 1000, server_timing_value(statement)))
+    response.headers['Server-Timing'] = ', '.join(metrics)
+    return response
@@ -4,13 +4,17 @@ from flask.ext.appbuilder.models.mixins import AuditMixin
 from sqlalchemy_searchable import make_searchable, search
 from sqlalchemy_utils.types import TSVectorType
 
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Text, Table, DateTime, Interval, CheckConstraint
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Text, Table, DateTime, Interval, CheckConstraint, UniqueConstraint
+from sqlalchemy import event, inspect, text, Index, DDL, and_
+from sqlalchemy.orm import relationship, Session, object_session
+from sqlalchemy.exc import IntegrityError
 from app import db, app
 
 from utils import format_bool, bool_as_lock, bool_as_special
 
 import datetime
+import itertools
+from collections import namedtuple
 
 make_searchable()
 
@@ -58,12 +62,20 @@ class Entry(AuditMixin, Model):
     until  = Column(DateTime)
     created = Column(DateTime, nullable=False)
     archivable = Column(Boolean)
+    # Cached result of ``is_visible(False)``, for queries that want
+    # to filter on a boolean (see ``refresh_live_flags``)
+    is_live = Column(Boolean, nullable=False, default=False, server_default='false')
 
     category_id = Column(Integer, ForeignKey('category.id'))
     category = relationship('Category', backref='entries')
 
     tags = relationship('Tag', secondary=assoc_entry_tag)
 
+    # Number of visible comments, maintained by ``update_comment_counts``
+    comment_count = Column(Integer, nullable=False, default=0, server_default='0')
+    # The number of the last comment, see ``next_comment_number``
+    comment_seq = Column(Integer, nullable=False, default=0, server_default='0')
+
     # Search:
     search_vector = Column(TSVectorType('title', 'lead', 'content'))
 
@@ -81,8 +93,16 @@ class Entry(AuditMixin, Model):
                ((not self.since) or self.since <= now) and \
                ((not self.until) or self.until >= now)
 
-    def highest_comment(self):
-        return max([0] + [cmt.number for cmt in self.comments])
+    def next_comment_number(self):
+        """Takes the next comment number of this entry.
+
+        The increment is atomic, and the entry's row stays locked until
+        the end of the transaction, so concurrent comments always get
+        different numbers."""
+        return object_session(self).execute(
+                text("""UPDATE entry SET comment_seq = comment_seq + 1
+                        WHERE id = :entry_id RETURNING comment_seq"""),
+                {'entry_id': self.id}).scalar()
 
     def pretty_commentable(self):
         return format_bool(self.commentable)
@@ -107,13 +127,41 @@ class Tag(AuditMixin, Model):
 
     entries = relationship('Entry', secondary=assoc_entry_tag)
 
-    def nr_of_visible_entries(self, is_preview):
-        return len([entry for entry in self.entries
-                     if entry.is_visible(is_preview)])
-
     def __repr__(self):
         return self.name
 
+class TagCount(Model):
+    """Materialized number of visible entries per tag.
+
+    The rows are a cache, maintained by ``query.tag_counts``.
+    They are deleted whenever an entry or a tag changes, and are
+    considered stale after ``valid_until``, the next moment at which
+    the ``since``/``until`` window of a tagged entry opens or closes."""
+    tag_id = Column(Integer, ForeignKey('tag.id', ondelete='CASCADE'),
+                    primary_key=True)
+    tag = relationship('Tag')
+    public_count = Column(Integer, nullable=False, default=0)
+    preview_count = Column(Integer, nullable=False, default=0)
+    valid_until = Column(DateTime)
+
+class ArchiveMonth(Model):
+    """Materialized number of archivable entries per month,
+    maintained by ``query.archive_months`` like ``TagCount``."""
+    year = Column(Integer, primary_key=True, autoincrement=False)
+    month = Column(Integer, primary_key=True, autoincrement=False)
+    public_count = Column(Integer, nullable=False, default=0)
+    preview_count = Column(Integer, nullable=False, default=0)
+    valid_until = Column(DateTime)
+
+class SummaryRefresh(Model):
+    """When a summary table (``TagCount``, ``ArchiveMonth``) was last
+    rebuilt, and until when its rows are valid. The row is deleted with
+    the rows of the table, so a table without rows but with this row
+    holds a (possibly empty) fresh summary."""
+    name = Column(String(64), primary_key=True)
+    refreshed_at = Column(DateTime, nullable=False)
+    valid_until = Column(DateTime)
+
 class Category(Model):
     id = Column(Integer, primary_key=True)
     name = Column(Text, unique=True)
@@ -127,6 +175,8 @@ class Category(Model):
 
 class Comment(Model):
     """A Blog Comment"""
+    __table_args__ = (
+        UniqueConstraint('entry_id', 'number', name='uq_comment_entry_id_number'),)
 
     id = Column(Integer, primary_key=True)
     name = Column(String(50))
@@ -178,5 +228,321 @@ class BlogConfig(AuditMixin, Model):
     def edit_lag(self):
         return datetime.timedelta(minutes=self.edit_lag_in_minutes)
 
+    def snapshot(self):
+        return BlogConfigSnapshot(*[getattr(self, field)
+                                    for field in BlogConfigSnapshot._fields])
+
     def __repr__(self):
         return self.name
+
+class BlogConfigSnapshot(namedtuple('BlogConfigSnapshot',
+        ['id', 'name', 'description', 'blog_title', 'blog_subtitle',
+         'edit_lag_in_minutes', 'window_title', 'entries_in_sidebar',
+         'entries_per_page', 'entries_in_feed', 'comments_in_feed',
+         'show_all_tab'])):
+    """An immutable copy of a ``BlogConfig``, detached from any session,
+    that can be shared between requests"""
+    __slots__ = ()
+
+    def edit_lag(self):
+        return datetime.timedelta(minutes=self.edit_lag_in_minutes)
+
+class VersionStamp(Model):
+    """A counter, incremented in the same transaction as every change
+    to the data it stands for.
+
+    Caches remember the version of the data they hold, and compare it
+    with the current one. See ``bump_versions`` below."""
+    name = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+# Indexes designed around the predicates and orderings of the ``query``
+# module. Entries are always listed by ``(created, id)``, the keys used
+# for pagination, so every entry index ends with these columns.
+#
+# Category pages (``query.entries(catslug=...)``):
+Index('ix_entry_category_id_created_id',
+      Entry.category_id, Entry.created, Entry.id)
+# Preview pages, which don't filter on visibility:
+Index('ix_entry_created_id', Entry.created, Entry.id)
+# Public pages, feeds and archives. Most entries are public and
+# archivable, but the partial index lets the planner walk the entries
+# in order and skip only the few that fail the ``since``/``until`` test.
+Index('ix_entry_public_archivable_created_id',
+      Entry.created, Entry.id,
+      postgresql_where=and_(Entry.public == True, Entry.archivable == True))
+# The same for the ``is_live`` flag (see ``query.publicly_visible``):
+Index('ix_entry_live_archivable_created_id',
+      Entry.created, Entry.id,
+      postgresql_where=and_(Entry.is_live == True, Entry.archivable == True))
+# The next time an entry appears or disappears
+# (see ``query.next_transition``):
+Index('ix_entry_since', Entry.since, postgresql_where=Entry.since != None)
+Index('ix_entry_until', Entry.until, postgresql_where=Entry.until != None)
+# Comments of an entry, in the order they are shown:
+Index('ix_comment_entry_id_published', Comment.entry_id, Comment.published)
+# The last comment of an entry (see ``query.entry_validator``):
+Index('ix_comment_entry_id_id', Comment.entry_id, Comment.id)
+# The comments feed:
+Index('ix_comment_visible_published', Comment.visible, Comment.published.desc())
+# Entries of a tag (tag pages, tag counts) and tags of an entry:
+Index('ix_entry_tag_tag_id_entry_id',
+      assoc_entry_tag.c.tag_id, assoc_entry_tag.c.entry_id)
+Index('ix_entry_tag_entry_id', assoc_entry_tag.c.entry_id)
+# Search suggestions (see ``query.suggestions``). The trigram indexes
+# serve both ``ILIKE '%...%'`` and the similarity operator ``%``.
+Index('ix_entry_title_trgm', Entry.title,
+      postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
+Index('ix_tag_name_trgm', Tag.name,
+      postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+
+# The trigram operators come from the ``pg_trgm`` extension,
+# which must exist before the indexes are created
+event.listen(Model.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm')\
+                 .execute_if(dialect='postgresql'))
+
+# ``make_searchable`` recomputes the search vector of an entry on every
+# ``UPDATE``, even one that only sets ``comment_count`` or ``is_live``
+# (see ``update_comment_counts`` and ``refresh_live_flags``). The trigger
+# is replaced by one that only fires when the indexed columns are set.
+# This runs after all the tables (and their triggers) have been created.
+ENTRY_SEARCH_TRIGGER = """
+    DROP TRIGGER IF EXISTS entry_search_vector_trigger ON entry;
+    CREATE TRIGGER entry_search_vector_trigger
+        BEFORE INSERT OR UPDATE OF title, lead, content ON entry
+        FOR EACH ROW EXECUTE PROCEDURE entry_search_vector_update()"""
+
+def creates_entry_table(ddl, target, bind, tables=None, **kw):
+    return tables is not None and Entry.__table__ in tables
+
+event.listen(Model.metadata, 'after_create',
+             DDL(ENTRY_SEARCH_TRIGGER).execute_if(dialect='postgresql',
+                                                  callable_=creates_entry_table))
+
+
+def changed_objects(session):
+    """The objects inserted, updated or deleted by a flush"""
+    return itertools.chain(session.new,
+                           session.deleted,
+                           [obj for obj in session.dirty
+                              if session.is_modified(obj)])
+
+# Version stamps that exist from the start (see ``initialize``)
+VERSION_STAMPS = ['config', 'sidebar', 'entries', 'comments']
+
+def version_stamps(obj):
+    """The names of the version stamps that change with ``obj``.
+
+    Besides the coarse stamps, there are stamps for single objects
+    (``'entry:<id>'``, ``'tag:<id>'``...), used by the pages that show
+    them (see ``page_cache``). Each of them is always bumped together
+    with a coarse stamp."""
+    if isinstance(obj, (BlogConfig, ChooseConfig)):
+        return ['config']
+    # The sidebar and the navbar show recent entries, sidebar modules,
+    # tag counts and categories.
+    # ``'entries'`` and ``'comments'`` stand for the Atom feeds
+    # and the lists of entries.
+    if isinstance(obj, Entry):
+        state = inspect(obj)
+        category_ids = set(state.attrs.category_id.history.sum())
+        category_ids.add(obj.category_id)
+        tags = state.attrs.tags.history.sum()
+        return ['sidebar', 'entries', 'comments', 'entry:{}'.format(obj.id)] + \
+               ['category:{}'.format(category_id)
+                  for category_id in category_ids if category_id is not None] + \
+               ['tag:{}'.format(tag.id) for tag in tags]
+    if isinstance(obj, Tag):
+        return ['sidebar', 'tag:{}'.format(obj.id)]
+    if isinstance(obj, Category):
+        return ['sidebar', 'category:{}'.format(obj.id)]
+    if isinstance(obj, SidebarModule):
+        return ['sidebar']
+    if isinstance(obj, Author):
+        return ['entries', 'author:{}'.format(obj.id)]
+    if isinstance(obj, Comment):
+        return ['comments'] + ['entry:{}'.format(entry_id)
+                               for entry_id in comment_entry_ids(obj)]
+    return []
+
+# The stamps bumped by the current transaction of a session are collected
+# in ``session.info[BUMPED_VERSIONS]``, and purged from the reverse proxy
+# after the commit (see ``purge``)
+BUMPED_VERSIONS = 'bumped_versions'
+
+def bump_versions(session, names):
+    session.info.setdefault(BUMPED_VERSIONS, set()).update(names)
+    for name in names:
+        bump_version(session, name)
+
+def bump_version(session, name):
+    table = VersionStamp.__table__
+    bump = table.update()\
+                .where(table.c.name == name)\
+                .values(version=table.c.version + 1)
+    if session.execute(bump).rowcount:
+        return
+    # Per-object stamps are created by their first bump. Two transactions
+    # may create the same one at the same time (the first two comments on
+    # an entry): the ``INSERT`` of the second one waits for the first one,
+    # and fails if it commits. The second one then goes back to the
+    # savepoint, and bumps the stamp created by the first one.
+    session.execute(text("SAVEPOINT insert_version_stamp"))
+    try:
+        session.execute(table.insert().values(name=name, version=1))
+    except IntegrityError:
+        session.execute(text("ROLLBACK TO SAVEPOINT insert_version_stamp"))
+        session.execute(bump)
+    else:
+        session.execute(text("RELEASE SAVEPOINT insert_version_stamp"))
+
+@event.listens_for(Session, 'after_flush')
+def bump_changed_versions(session, flush_context):
+    names = set()
+    for obj in changed_objects(session):
+        names.update(version_stamps(obj))
+    bump_versions(session, sorted(names))
+
+
+# Attributes of an ``Entry`` that change the number of visible
+# entries of a tag or of a month in the archives.
+TAG_COUNT_ATTRIBUTES = ['public', 'since', 'until', 'tags']
+ARCHIVE_ATTRIBUTES = ['public', 'since', 'until', 'created', 'archivable']
+
+def has_changes(obj, attributes):
+    """Tests whether any of the ``attributes`` of ``obj`` has been
+    changed in the current flush"""
+    state = inspect(obj)
+    return any(state.attrs[attr].history.has_changes()
+               for attr in attributes)
+
+def changes_tag_counts(session):
+    for obj in session.new.union(session.deleted):
+        if isinstance(obj, (Entry, Tag)):
+            return True
+    for obj in session.dirty:
+        if isinstance(obj, Entry) and has_changes(obj, TAG_COUNT_ATTRIBUTES):
+            return True
+    return False
+
+def changes_archive(session):
+    for obj in session.new.union(session.deleted):
+        if isinstance(obj, Entry):
+            return True
+    for obj in session.dirty:
+        if isinstance(obj, Entry) and has_changes(obj, ARCHIVE_ATTRIBUTES):
+            return True
+    return False
+
+# Rebuilding the summaries (see ``query.refresh_summary``) and deleting
+# them exclude each other through a PostgreSQL advisory lock. Writers take
+# it shared, until the end of their transaction, so that they don't wait
+# for each other, and a rebuild takes it exclusive. Otherwise a rebuild
+# could count the entries before a writer commits, and store its counts
+# after the writer has deleted the old ones.
+SUMMARY_LOCK = 0x666c6f67
+
+def lock_summaries(session):
+    session.execute(text("SELECT pg_advisory_xact_lock_shared(:key)"),
+                    {'key': SUMMARY_LOCK})
+
+@event.listens_for(Session, 'before_flush')
+def lock_changed_summaries(session, flush_context, instances):
+    # Before the flush, so that the writer doesn't hold locks on the rows
+    # of the entries and tags while it waits for a rebuild to finish
+    if changes_tag_counts(session) or changes_archive(session):
+        lock_summaries(session)
+
+@event.listens_for(Session, 'after_flush')
+def invalidate_summaries(session, flush_context):
+    # Deleting the rows in the same transaction as the change
+    # makes sure no reader ever sees counts older than the entries.
+    # The counts are rebuilt lazily by ``query.tag_counts``
+    # and ``query.archive_months``.
+    if changes_tag_counts(session):
+        clear_summary(session, TagCount)
+    if changes_archive(session):
+        clear_summary(session, ArchiveMonth)
+
+def clear_summary(session, model):
+    table = model.__table__
+    refresh = SummaryRefresh.__table__
+    lock_summaries(session)
+    session.execute(table.delete())
+    session.execute(refresh.delete().where(refresh.c.name == table.name))
+
+
+# Attributes of a ``Comment`` that change the number of visible
+# comments of an entry.
+COMMENT_COUNT_ATTRIBUTES = ['visible', 'entry_id', 'entry']
+
+def update_comment_counts(session, entry_ids=None):
+    """Recounts the visible comments of the given entries (or of all
+    entries if ``entry_ids`` is ``None``)"""
+    # Plain SQL, so that ``AuditMixin`` doesn't touch ``changed_on``
+    # and ``changed_by`` just because someone has commented.
+    statement = """UPDATE entry SET comment_count =
+                     (SELECT count(*) FROM comment
+                      WHERE comment.entry_id = entry.id AND comment.visible)"""
+    if entry_ids is None:
+        return session.execute(text(statement))
+    return session.execute(text(statement + " WHERE entry.id = ANY(:entry_ids)"),
+                           {'entry_ids': list(entry_ids)})
+
+def comment_entry_ids(comment):
+    """The ids of the entries the comment belongs (or belonged) to"""
+    state = inspect(comment)
+    ids = set(state.attrs.entry_id.history.sum())
+    ids.update(entry.id for entry in state.attrs.entry.history.sum()
+                 if entry is not None)
+    ids.add(comment.entry_id)
+    ids.discard(None)
+    return ids
+
+@event.listens_for(Session, 'after_flush')
+def maintain_comment_counts(session, flush_context):
+    # This runs for comments created by ``routes.create_comment``,
+    # edited by ``routes.update_comment`` or moderated in the admin
+    # interface, always inside the transaction that changes them.
+    entry_ids = set()
+    for obj in session.new.union(session.deleted):
+        if isinstance(obj, Comment):
+            entry_ids.update(comment_entry_ids(obj))
+    for obj in session.dirty:
+        if isinstance(obj, Comment) and has_changes(obj, COMMENT_COUNT_ATTRIBUTES):
+            entry_ids.update(comment_entry_ids(obj))
+    if entry_ids:
+        update_comment_counts(session, entry_ids)
+
+
+# ``Entry.is_live`` is set whenever an entry is written, and flipped by
+# ``refresh_live_flags`` when the ``since``/``until`` window of an entry
+# opens or closes. ``python manager.py live_tick`` calls it at every
+# transition.
+LIVE_ATTRIBUTES = ['public', 'since', 'until']
+
+# Version stamps of data that depends on which entries are visible
+VISIBILITY_STAMPS = ['sidebar', 'entries', 'comments']
+
+@event.listens_for(Session, 'before_flush')
+def set_live_flags(session, flush_context, instances):
+    for obj in itertools.chain(session.new, session.dirty):
+        if isinstance(obj, Entry) and \
+                (obj in session.new or has_changes(obj, LIVE_ATTRIBUTES)):
+            obj.is_live = bool(obj.is_visible(False))
+
+def refresh_live_flags(session, now):
+    """Flips the ``is_live`` flag of the entries whose window has opened
+    or closed. Returns the number of flipped entries."""
+    # Plain SQL, for the same reasons as in ``update_comment_counts``
+    result = session.execute(text("""
+        UPDATE entry SET is_live = NOT is_live
+        WHERE is_live <> (coalesce(public, false)
+                          AND (since IS NULL OR since <= :now)
+                          AND (until IS NULL OR until >= :now))"""),
+        {'now': now})
+    if result.rowcount:
+        bump_versions(session, VISIBILITY_STAMPS)
+    return result.rowcount
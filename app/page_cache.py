@@ -0,0 +1,189 @@
+from flask import g, request, session, Response, Markup
+
+from app import app
+from cache import pages
+import query
+
+import datetime
+import gzip
+import re
+import cStringIO
+import time
+
+# Full-page cache for the public pages seen by anonymous readers.
+#
+# Pages are the same for every reader, except for a few *holes*, such as
+# the "Edit" links of the comments the reader has just posted. Templates write holes as ``{{ hole(name, ...) }}``.
+# When a page is about to be cached, each hole is rendered as a marker,
+# and the page is stored with the markers. When the page is served from
+# the cache, the markers are replaced by the holes rendered for the
+# current reader. The arguments of a hole must be plain values.
+#
+# A cached page depends on the version stamps listed in ``g.page_deps``
+# (see ``depends_on`` and ``models.version_stamps``): coarse ones such as
+# ``'config'`` and ``'sidebar'``, and per-object ones such as
+# ``'entry:42'`` or ``'tag:7'``. A cached page is served only if none of
+# them has changed, and expires at the next ``since``/``until`` transition.
+#
+# Checking the stamps costs one query. Pages checked less than
+# ``PAGE_CACHE_TRUST`` seconds ago are served without any query
+# (except to readers who have commented, who always get a checked page).
+
+HOLE_MARKER = '<!--page-cache-hole:{}-->'
+HOLE_MARKER_RE = re.compile(r'<!--page-cache-hole:(\d+)-->')
+
+# Functions that render the holes, by name (see ``hole_renderer``)
+HOLES = {}
+
+def hole_renderer(name):
+    def register(function):
+        HOLES[name] = function
+        return function
+    return register
+
+@app.template_global()
+def hole(name, **kwargs):
+    holes = getattr(g, 'page_holes', None)
+    if holes is None:
+        return Markup(HOLES[name](**kwargs))
+    holes.append((name, kwargs))
+    return Markup(HOLE_MARKER.format(len(holes) - 1))
+
+def depends_on(*names):
+    """Declares that the current response depends on the version stamps ``names``"""
+    g.page_deps.update(names)
+
+class CachedPage(object):
+    def __init__(self, parts, holes, content_type):
+        # The page is ``parts[0] + hole 0 + parts[1] + hole 1 + ...``
+        self.parts = parts
+        self.holes = holes
+        # The version stamps the page depends on, when it was rendered
+        self.versions = {}
+        self.content_type = content_type
+        # Pages without holes are also stored compressed
+        self.gzipped = None
+        self.checked_at = time.time()
+        # The next ``since``/``until`` transition, when the page expires
+        self.expires = None
+        # The weak ``ETag`` of the page, if the view gave it one
+        self.etag = None
+
+    def body(self):
+        chunks = [self.parts[0]]
+        for ((name, kwargs), part) in zip(self.holes, self.parts[1:]):
+            chunks.append(unicode(HOLES[name](**kwargs)).encode('utf-8'))
+            chunks.append(part)
+        return ''.join(chunks)
+
+def compress(data):
+    buf = cStringIO.StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+        f.write(data)
+    return buf.getvalue()
+
+def is_cacheable():
+    return app.config['PAGE_CACHE'] and \
+        request.method == 'GET' and \
+        request.endpoint in CACHEABLE_ENDPOINTS and \
+        not request.view_args.get('edit_id') and \
+        not session.get('_flashes') and \
+        not g.user.is_authenticated()
+
+# The cacheable endpoints, with the query arguments their views read.
+# Other arguments (``?utm_source=...``) don't change the page, and must
+# not make a new entry in the cache.
+CACHEABLE_ENDPOINTS = {
+    'PublicView.category': [],
+    'PublicView.all_entries': [],
+    'PublicView.entry': [],
+    'PublicView.tag': [],
+    'PublicView.archives': [],
+    'PublicView.archives_year': [],
+    'PublicView.search_results_entries': [],
+}
+
+def page_key():
+    args = tuple((name, tuple(request.args.getlist(name)))
+                 for name in CACHEABLE_ENDPOINTS[request.endpoint])
+    return (request.host, request.path, args)
+
+def is_fresh(page):
+    # Readers who have commented must see their comments at once
+    if time.time() - page.checked_at < app.config['PAGE_CACHE_TRUST'] and \
+            not session.get('comments'):
+        # Not to be stored by shared caches (see ``routes.add_cache_headers``)
+        g.page_unchecked = True
+        return True
+    if query.versions(page.versions.keys()) != page.versions:
+        return False
+    page.checked_at = time.time()
+    return True
+
+def cached_page():
+    """The cached response for the current request, or ``None``.
+
+    If the page is not cached but can be, starts recording the holes."""
+    if not is_cacheable():
+        return None
+    page = pages.get(page_key())
+    if page is not None and is_fresh(page):
+        g.page_deps.update(page.versions)
+        g.next_transition = page.expires
+        # The "Edit" links depend on the time (see ``SiteView.entry``)
+        etag = page.etag if not session.get('comments') else None
+        if etag is not None and request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        elif page.gzipped is not None and request.accept_encodings['gzip']:
+            response = Response(page.gzipped, content_type=page.content_type)
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(page.body(), content_type=page.content_type)
+        if etag is not None:
+            response.set_etag(etag, weak=True)
+        response.vary.add('Accept-Encoding')
+        response.headers['X-Page-Cache'] = 'hit'
+        return response
+    g.page_holes = []
+    return None
+
+@app.after_request
+def store_page(response):
+    holes = getattr(g, 'page_holes', None)
+    if holes is None or response.is_streamed:
+        return response
+    g.page_holes = None
+
+    # ``[part, index, part, index, ..., part]``: the holes are taken
+    # by index, in the order they appear in the page
+    pieces = HOLE_MARKER_RE.split(response.get_data())
+    parts = pieces[::2]
+    page = CachedPage(parts, [holes[int(index)] for index in pieces[1::2]],
+                      response.content_type)
+    # This reader gets the page with the holes filled in, whether it
+    # is stored or not
+    if holes:
+        response.set_data(page.body())
+    if response.status_code != 200:
+        return response
+
+    # The stamps in ``g.versions`` were read before the page was rendered.
+    # The stamps of the page are read in the same query as the current
+    # values of those: if any of them has changed since, the data of the
+    # page may be older than the stamps, and it is not stored. Every
+    # per-object stamp is bumped together with one of them, so if none
+    # has changed, the stamps of the page are those the page was
+    # rendered with.
+    current = query.versions(list(g.page_deps.union(g.versions)))
+    if any(current[name] != version for (name, version) in g.versions.items()):
+        return response
+    page.versions = dict((name, current[name]) for name in g.page_deps)
+    page.etag = response.get_etag()[0]
+    if not holes:
+        page.gzipped = compress(parts[0])
+
+    now = datetime.datetime.utcnow()
+    page.expires = query.next_transition(now)
+    pages.set(page_key(), page, page.expires)
+    response.headers['X-Page-Cache'] = 'miss'
+    return response
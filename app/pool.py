@@ -0,0 +1,121 @@
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+import os
+import time
+
+# The database engines are created when the app is imported, before
+# a prefork server (uWSGI, gunicorn) starts its workers. A connection
+# opened before the fork would be shared by several processes, so:
+#
+# - ``dispose_engines`` closes the connections of all the engines. It
+#   runs after the app is initialized and again in each worker (under
+#   uWSGI automatically; with gunicorn, call it from ``post_fork``);
+# - as a safety net, every connection remembers the process that opened
+#   it, and is discarded if another process tries to check it out.
+
+class PoolStats(object):
+    """Counters of a ``TimedQueuePool``.
+
+    A *wait* is a checkout that found all the connections in use and
+    no overflow left, so that it had to wait for a connection to be
+    returned. Times are in seconds."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+
+    def record(self, elapsed, waited):
+        self.checkouts += 1
+        if waited:
+            self.waits += 1
+            self.wait_time += elapsed
+            self.max_wait = max(self.max_wait, elapsed)
+
+class TimedQueuePool(QueuePool):
+    """A ``QueuePool`` that counts its checkouts and the time spent
+    waiting for a connection (see ``PoolStats``)"""
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self.stats = PoolStats()
+
+    def recreate(self):
+        # Called by ``Engine.dispose``: keep counting
+        pool = QueuePool.recreate(self)
+        pool.stats = self.stats
+        return pool
+
+    def _do_get(self):
+        waited = self._pool.empty() and \
+            self._max_overflow > -1 and self._overflow >= self._max_overflow
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        except exc.TimeoutError:
+            self.stats.timeouts += 1
+            raise
+        finally:
+            self.stats.record(time.time() - start, waited)
+
+    def snapshot(self):
+        return dict(size=self.size(),
+                    checked_out=self.checkedout(),
+                    checked_in=self.checkedin(),
+                    overflow=self.overflow(),
+                    checkouts=self.stats.checkouts,
+                    waits=self.stats.waits,
+                    wait_time=self.stats.wait_time,
+                    max_wait=self.stats.max_wait,
+                    timeouts=self.stats.timeouts)
+
+@event.listens_for(TimedQueuePool, 'connect')
+def remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+@event.listens_for(TimedQueuePool, 'checkout')
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info['pid'] != pid:
+        # Forget the connection without closing it: it belongs
+        # to the parent process
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "Connection record belongs to pid {}, "
+            "attempting to check out in pid {}"\
+            .format(connection_record.info['pid'], pid))
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Tests a connection before it is used. If the server closed it
+    (restart, idle timeout), the pool replaces it with a new one."""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+        cursor.close()
+    except Exception:
+        raise exc.DisconnectionError()
+
+def configure_pool(app):
+    """Installs the optional checkout ping (``SQLALCHEMY_POOL_PRE_PING``)"""
+    if app.config['SQLALCHEMY_POOL_PRE_PING']:
+        # Registered after ``check_pid``, so it runs after it
+        event.listen(TimedQueuePool, 'checkout', ping_connection)
+
+def pool_options(app):
+    return dict(poolclass=TimedQueuePool,
+                max_overflow=app.config['SQLALCHEMY_MAX_OVERFLOW'])
+
+def engine_binds(app):
+    """The primary database (``None``) and the binds of the replicas"""
+    return [None] + sorted(app.config.get('SQLALCHEMY_BINDS') or {})
+
+def dispose_engines(db, app):
+    for bind in engine_binds(app):
+        db.get_engine(app, bind).dispose()
+
+def pool_stats(db, app):
+    return dict((bind or 'primary', db.get_engine(app, bind).pool.snapshot())
+                for bind in engine_binds(app))
@@ -0,0 +1,126 @@
+from flask import g, request, url_for
+
+from app import app
+from instrumentation import is_admin
+
+import cProfile
+import collections
+import datetime
+import os
+import sys
+import threading
+import uuid
+
+# Admins can profile a single request in production, by sending the
+# ``X-Profile`` header or adding ``?_profile=`` to the URL, with one of
+# the values:
+#
+# - ``cprofile`` (or ``1``): deterministic profile, saved as a ``.pstats``
+#   file (open it with ``python -m pstats`` or snakeviz);
+# - ``sample``: the call stack is sampled every ``PROFILE_SAMPLE_INTERVAL``
+#   seconds, and the samples are saved in the "collapsed" format read by
+#   ``flamegraph.pl`` and speedscope.
+#
+# The file is saved in ``PROFILE_DIR`` and its download URL is sent in the
+# ``X-Profile`` response header. For anyone else, the flag is ignored and
+# costs nothing but the lookup.
+#
+# The profile covers the request from the ``before_request`` hooks to
+# the ``teardown_request`` hooks. The body of streamed pages is rendered
+# later, and is not included. The profile of a request that failed is
+# saved too, but it has no response to carry its URL.
+
+class Sampler(object):
+    """Samples the call stack of a thread from another thread"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def enable(self):
+        self.thread.start()
+
+    def disable(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.counts[collapse(frame)] += 1
+
+    def dump_stats(self, path):
+        with open(path, 'w') as f:
+            for (stack, count) in self.counts.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+def collapse(frame):
+    """The stack of ``frame`` as ``outermost;...;innermost``"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{}:{}'.format(os.path.basename(code.co_filename),
+                                    code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+PROFILERS = {
+    '1': ('pstats', lambda: cProfile.Profile()),
+    'cprofile': ('pstats', lambda: cProfile.Profile()),
+    'sample': ('collapsed',
+               lambda: Sampler(threading.current_thread().ident,
+                               app.config['PROFILE_SAMPLE_INTERVAL'])),
+}
+
+def requested_profiler():
+    flag = request.headers.get('X-Profile') or request.args.get('_profile')
+    if flag is None or flag not in PROFILERS or not is_admin():
+        return None
+    return flag
+
+@app.before_request
+def start_profiler():
+    flag = requested_profiler()
+    if flag is not None:
+        extension, profiler = PROFILERS[flag]
+        g.profiler = (extension, profiler())
+        g.profiler[1].enable()
+
+def profile_filename(extension):
+    return '{:%Y%m%d-%H%M%S}-{}-{}.{}'.format(
+        datetime.datetime.utcnow(),
+        (request.endpoint or 'none').replace('.', '-'),
+        uuid.uuid4().hex[:8],
+        extension)
+
+@app.after_request
+def add_profile_header(response):
+    if getattr(g, 'profiler', None) is None:
+        return response
+    # The profile is saved under this name by ``save_profile``
+    g.profile_filename = profile_filename(g.profiler[0])
+    response.headers['X-Profile'] = url_for('ClientApi.profile',
+                                            filename=g.profile_filename,
+                                            _external=True)
+    return response
+
+# ``teardown_request`` runs even when the view raises an exception,
+# so the profiler is always stopped (and the sampler thread joined)
+@app.teardown_request
+def save_profile(exception):
+    if getattr(g, 'profiler', None) is None:
+        return
+    extension, profiler = g.profiler
+    profiler.disable()
+    g.profiler = None
+
+    filename = getattr(g, 'profile_filename', None) or profile_filename(extension)
+    profile_dir = app.config['PROFILE_DIR']
+    if not os.path.exists(profile_dir):
+        os.makedirs(profile_dir)
+    profiler.dump_stats(os.path.join(profile_dir, filename))
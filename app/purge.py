@@ -0,0 +1,144 @@
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app import app
+from models import BUMPED_VERSIONS
+from routes import is_public_endpoint
+
+import heapq
+import itertools
+import logging
+import os
+import Queue
+import requests
+import threading
+import time
+
+# Support for a reverse proxy (Varnish with the xkey module, or any
+# cache that purges by surrogate key) in front of the app.
+#
+# Every public response lists the version stamps it depends on
+# (``g.page_deps``, see ``page_cache``) in its ``Surrogate-Key`` and
+# ``xkey`` headers: ``config``, ``sidebar``, ``entries``, ``comments``,
+# ``entry:42``, ``tag:7``... When a transaction that bumped some stamps
+# is committed, the stamps are sent to ``PURGE_URL``, in batches of
+# ``PURGE_BATCH_SIZE`` keys per request, so the proxy drops the responses
+# tagged with them. It doesn't matter where the change comes from
+# (the public pages, the REST API, the admin views or ``live_tick``).
+#
+# The purges are sent by a background thread, so that a write never
+# waits for the proxy. A failed purge is logged: the responses stay in
+# the proxy until their ``s-maxage``.
+#
+# Right after a purge, the proxy may fetch the page again and get it
+# from a read replica that hasn't seen the change yet (see ``replicas``).
+# Each purge is repeated ``PURGE_REPEAT_AFTER`` seconds later, to drop
+# what was stored in the meantime. (Pages served by the page cache
+# without checking the version stamps are never stored by the proxy,
+# see ``routes.add_cache_headers``.)
+
+log = logging.getLogger(__name__)
+
+@app.after_request
+def add_surrogate_keys(response):
+    deps = getattr(g, 'page_deps', None)
+    if deps and request.method in ['GET', 'HEAD'] and \
+            is_public_endpoint(request.endpoint):
+        keys = ' '.join(sorted(deps))
+        response.headers['Surrogate-Key'] = keys
+        response.headers['xkey'] = keys
+    return response
+
+def batches(keys, size):
+    keys = sorted(keys)
+    for i in range(0, len(keys), size):
+        yield keys[i:i + size]
+
+def purge(keys):
+    """Asks the proxy to drop the responses tagged with any of ``keys``.
+    Returns ``True`` if every request succeeded."""
+    url = app.config['PURGE_URL']
+    ok = True
+    for batch in batches(keys, app.config['PURGE_BATCH_SIZE']):
+        try:
+            response = requests.request(
+                app.config['PURGE_METHOD'], url,
+                headers={app.config['PURGE_KEY_HEADER']: ' '.join(batch)},
+                timeout=app.config['PURGE_TIMEOUT'])
+            response.raise_for_status()
+        except requests.RequestException as e:
+            log.warning("Purging %s from %s failed: %s", ' '.join(batch), url, e)
+            ok = False
+    return ok
+
+class Purger(object):
+    """Sends the purges from a background thread, one per process"""
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def enqueue(self, keys):
+        self.start()
+        self.queue.put((time.time(), frozenset(keys)))
+
+    def start(self):
+        # A forked worker doesn't inherit the thread of its parent
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.queue = Queue.Queue()
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        # Heap of ``(due, n, keys, repeated)``; ``n`` keeps the order stable
+        pending = []
+        counter = itertools.count()
+        while True:
+            timeout = max(0, pending[0][0] - time.time()) if pending else None
+            try:
+                due, keys = self.queue.get(timeout=timeout)
+                heapq.heappush(pending, (due, next(counter), keys, False))
+                # The keys of the writes of the same moment go together
+                while True:
+                    due, keys = self.queue.get_nowait()
+                    heapq.heappush(pending, (due, next(counter), keys, False))
+            except Queue.Empty:
+                pass
+
+            now = time.time()
+            keys, repeat = set(), set()
+            while pending and pending[0][0] <= now:
+                _, _, due_keys, repeated = heapq.heappop(pending)
+                keys.update(due_keys)
+                if not repeated:
+                    repeat.update(due_keys)
+            if not keys:
+                continue
+            try:
+                purge(keys)
+            except Exception:
+                # The thread must survive anything
+                log.exception("Purging %s failed", ' '.join(sorted(keys)))
+            delay = app.config['PURGE_REPEAT_AFTER']
+            if delay and repeat:
+                heapq.heappush(pending, (now + delay, next(counter),
+                                         frozenset(repeat), True))
+
+purger = Purger()
+
+@event.listens_for(Session, 'after_commit')
+def purge_bumped_versions(session):
+    keys = session.info.pop(BUMPED_VERSIONS, None)
+    if keys and app.config['PURGE_URL']:
+        purger.enqueue(keys)
+
+@event.listens_for(Session, 'after_rollback')
+def forget_bumped_versions(session):
+    # Nothing was changed, there is nothing to purge
+    session.info.pop(BUMPED_VERSIONS, None)
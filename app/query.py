@@ -1,12 +1,70 @@
-from models import Entry, SidebarModule, Comment, ChooseConfig, Category, Author, Tag
+from models import Entry, SidebarModule, Comment, ChooseConfig, BlogConfig, Category, Author, Tag, TagCount, ArchiveMonth, SummaryRefresh, VersionStamp, assoc_entry_tag, SUMMARY_LOCK
 from app import app, db
+from sqlalchemy import func, case, and_, or_, tuple_, extract, cast, text, String, Float, REAL
+from sqlalchemy.orm import joinedload, defer, load_only, aliased
+from sqlalchemy_searchable import parse_search_query
 import datetime
 
 # Functions whose name is plural (e.g. ``categories``)
 # return a query. Functions whose name is singular
 # (e.g. ``category``) return a single object or ``None``
+#
+# The exceptions are ``tag_counts`` and ``archive_months``,
+# which return lists of tuples.
 
 
+def in_time_window(now):
+    """SQL condition: the entry's ``since``/``until`` window contains ``now``"""
+    return and_(or_(Entry.since == None, Entry.since <= now),
+                or_(Entry.until == None, Entry.until >= now))
+
+def publicly_visible(now):
+    """SQL condition: the entry is visible in the *public* version.
+
+    With ``ENTRY_LIVE_FLAG``, this tests the ``Entry.is_live`` flag
+    maintained by ``models.refresh_live_flags`` instead of comparing
+    dates, which is cheaper and lets the planner use a partial index.
+    The flag is only as fresh as the last tick (see ``LiveTick``)."""
+    if app.config.get('ENTRY_LIVE_FLAG'):
+        return Entry.is_live == True
+    return and_(Entry.public == True, in_time_window(now))
+
+
+# Loading profiles.
+#
+# Each kind of page touches different attributes of its entries.
+# Left to the defaults, every ``entry.author`` or ``entry.category``
+# in a template is a separate query, and every entry drags along its
+# ``search_vector``. A profile is the list of loader options with the
+# relationships and columns a kind of page needs, so that the number
+# of queries doesn't depend on the number of entries.
+LOADING_PROFILES = {
+    # Pages showing the full entries (category, all)
+    'list': [joinedload(Entry.author),
+             defer(Entry.search_vector)],
+    # Pages showing only the lead (tag, search results)
+    'summary': [joinedload(Entry.author),
+                defer(Entry.content),
+                defer(Entry.search_vector)],
+    # A single entry and the category tab it belongs to
+    'detail': [joinedload(Entry.author),
+               joinedload(Entry.category),
+               defer(Entry.search_vector)],
+    # The Atom feed of entries
+    'feed': [joinedload(Entry.author),
+             defer(Entry.search_vector)],
+    # Titles and the fields that decide visibility
+    # (archives, recent entries in the sidebar)
+    'archive': [load_only('id', 'slug', 'title', 'created',
+                          'public', 'since', 'until')]
+}
+
+def with_profile(q, profile):
+    """Applies the loading profile named ``profile`` to an ``Entry`` query"""
+    if profile is None:
+        return q
+    return q.options(*LOADING_PROFILES[profile])
+
 def category(name=None, slug=None):
     if name:
         return db.session.query(Category).filter_by(name=name).first()
@@ -31,8 +89,36 @@ def home_category():
     else:
         return db.session.query(Category).first()
 
-def blog_config():
-    return db.session.query(ChooseConfig).first().chosen_config
+def versions(names):
+    """The current values of the version stamps ``names``, as a ``dict``.
+    Stamps that were never bumped have version 0."""
+    stamps = dict((name, 0) for name in names)
+    stamps.update(db.session.query(VersionStamp.name, VersionStamp.version)\
+                    .filter(VersionStamp.name.in_(names)))
+    return stamps
+
+# Process-wide cache for the chosen ``BlogConfig``.
+# Holds a pair ``(version, snapshot)``.
+_blog_config = {}
+
+def blog_config(version=None):
+    """The chosen ``BlogConfig``, as an immutable ``BlogConfigSnapshot``.
+
+    The snapshot is reloaded from the DB only when the ``'config'``
+    version stamp is different from the version it was loaded with.
+    Pass the ``version`` if you have already read it."""
+    if version is None:
+        version = versions(['config'])['config']
+    cached = _blog_config.get('config')
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    config = db.session.query(BlogConfig)\
+        .join(ChooseConfig, ChooseConfig.chosen_config_id == BlogConfig.id)\
+        .first()
+    snapshot = config.snapshot()
+    _blog_config['config'] = (version, snapshot)
+    return snapshot
 
 def comment(comment_id):
     return db.session.query(Comment).get(comment_id)
@@ -47,23 +133,204 @@ def comments(entry_id, visible_only=True):
     else:
         return q
 
-def entry(slug, is_preview=False):
+def feed_comments(limit):
+    """The newest visible comments on publicly visible entries, with
+    only the columns the comments feed shows and the slug of their entry.
+
+    Served by the ``(visible, published)`` index, and fetched a few rows
+    at a time."""
+    now = datetime.datetime.utcnow()
+    return db.session.query(Comment.id, Comment.name, Comment.content,
+                            Comment.published, Entry.slug)\
+        .join(Entry, Entry.id == Comment.entry_id)\
+        .filter(Comment.visible == True,
+                or_(Comment.confirmed_spam == None,
+                    Comment.confirmed_spam == False),
+                publicly_visible(now))\
+        .order_by(Comment.published.desc())\
+        .limit(limit)\
+        .execution_options(stream_results=True)\
+        .yield_per(100)
+
+def search_entries(is_preview, search_query, page_size, after=None):
+    """The entries matching ``search_query``, best match first.
+
+    Returns at most ``page_size`` rows with the columns shown on the search
+    results page, the ``rank`` of the entry and a ``headline``: fragments
+    of its content with the matching words highlighted. ``after`` is the
+    ``(rank, id)`` key of the last entry of the previous page
+    (see ``utils.decode_search_cursor``).
+
+    The matching entries are ranked in a subquery, and the headlines,
+    which are expensive, are computed only for the rows of the page."""
+    now = datetime.datetime.utcnow()
+    tsquery = func.to_tsquery(parse_search_query(search_query))
+    rank = func.ts_rank(Entry.search_vector, tsquery)
+
+    # ``ts_rank`` is a ``real``. It is sent to the client as a
+    # ``double precision``, whose text form has enough digits to give back
+    # the exact ``real``, and the key of the cursor is cast back to a
+    # ``real``, so that the last entry of a page compares as equal to
+    # itself, and ties are broken by the ``id``.
+    ranked = db.session.query(Entry.id.label('id'),
+                              cast(rank, Float(53)).label('rank'))\
+        .filter(Entry.search_vector.op('@@')(tsquery))
+    if not is_preview:
+        ranked = ranked.filter(publicly_visible(now))
+    if after is not None:
+        after_rank, after_id = after
+        ranked = ranked.filter(tuple_(rank, Entry.id) <
+                               tuple_(cast(after_rank, REAL), after_id))
+    ranked = ranked.order_by(rank.desc(), Entry.id.desc())\
+        .limit(page_size)\
+        .subquery()
+
+    # The content is HTML: the tags are removed before highlighting
+    text = func.regexp_replace(Entry.content, '<[^>]*>', ' ', 'g')
+    headline = func.ts_headline(text, tsquery,
+                                'MaxFragments=2, MinWords=10, MaxWords=30')
+    return db.session.query(Entry.id, Entry.slug, Entry.title, Entry.created,
+                            Entry.show_author, Author.name.label('author'),
+                            ranked.c.rank, headline.label('headline'))\
+        .join(ranked, ranked.c.id == Entry.id)\
+        .outerjoin(Author, Author.id == Entry.author_id)\
+        .order_by(ranked.c.rank.desc(), Entry.id.desc())
+
+# Search suggestions use the trigram indexes on the entry titles and the
+# tag names (``pg_trgm``). The similarity operator is written ``%%``,
+# because psycopg2 would take a single ``%`` for a placeholder.
+
+def like_pattern(text):
+    """An ``ILIKE`` pattern for the strings containing ``text``"""
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return u'%' + escaped + u'%'
+
+def suggestions(is_preview, text, limit):
+    """Entry titles and tag names containing ``text``, most similar first.
+
+    Returns at most ``limit`` tuples ``(kind, title, slug)``,
+    where ``kind`` is ``'entry'`` or ``'tag'``."""
+    now = datetime.datetime.utcnow()
+    pattern = like_pattern(text)
+
+    title_similarity = func.similarity(Entry.title, text)
+    entries = db.session.query(Entry.title, Entry.slug, title_similarity)\
+        .filter(Entry.title.ilike(pattern, escape='\\'))
+    if not is_preview:
+        entries = entries.filter(publicly_visible(now))
+    entries = entries.order_by(title_similarity.desc()).limit(limit)
+
+    name_similarity = func.similarity(Tag.name, text)
+    tags = db.session.query(Tag.name, Tag.slug, name_similarity)\
+        .filter(Tag.name.ilike(pattern, escape='\\'))\
+        .order_by(name_similarity.desc())\
+        .limit(limit)
+
+    rows = [('entry', title, slug, similarity)
+            for (title, slug, similarity) in entries] +\
+           [('tag', name, slug, similarity)
+            for (name, slug, similarity) in tags]
+    rows.sort(key=lambda row: row[-1], reverse=True)
+    return [row[:-1] for row in rows[:limit]]
+
+def did_you_mean(is_preview, search_query):
+    """The entry title or tag name most similar to ``search_query``,
+    or ``None`` if nothing is similar enough.
+
+    Meant for searches without results, usually because of a typo."""
+    now = datetime.datetime.utcnow()
+
+    title_similarity = func.similarity(Entry.title, search_query)
+    entry = db.session.query(Entry.title, title_similarity)\
+        .filter(Entry.title.op('%%')(search_query))
+    if not is_preview:
+        entry = entry.filter(publicly_visible(now))
+    entry = entry.order_by(title_similarity.desc()).first()
+
+    name_similarity = func.similarity(Tag.name, search_query)
+    tag = db.session.query(Tag.name, name_similarity)\
+        .filter(Tag.name.op('%%')(search_query))\
+        .order_by(name_similarity.desc())\
+        .first()
+
+    candidates = [row for row in (entry, tag) if row is not None]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda row: row[1])[0]
+
+def entry(slug, is_preview=False, profile=None):
+    q = with_profile(db.session.query(Entry), profile)
     if is_preview:
-        return db.session.query(Entry).filter_by(slug=slug).first()
+        return q.filter_by(slug=slug).first()
     else:
-        return db.session.query(Entry).filter_by(slug=slug, public=True).first()
+        return q.filter_by(slug=slug, public=True).first()
+
+def entry_validator(slug, is_preview, now):
+    """A row that changes whenever the page of the entry ``slug`` may
+    change, or ``None`` if there is no such entry. It starts with the
+    ``id`` and ``author_id`` of the entry. It is a single query, and each
+    part of it is an index lookup:
+
+    - the ``changed_on`` date of the entry and the id of its last comment;
+    - the version stamps of the entry (bumped by any change to its
+      comments, including edits and moderation) and of its author;
+    - the ``'config'`` and ``'sidebar'`` version stamps;
+    - the next ``since``/``until`` transition, because the sidebar and the
+      navbar show the recent entries, which appear and disappear with time.
+    """
+    # An alias, so that the subqueries of ``next_transition_query``
+    # are not correlated with the entry
+    entry = aliased(Entry)
+    def stamp(name):
+        return db.session.query(VersionStamp.version)\
+                 .filter(VersionStamp.name == name)\
+                 .as_scalar()
+    last_comment = db.session.query(func.max(Comment.id))\
+        .filter(Comment.entry_id == entry.id)\
+        .as_scalar()
+    q = db.session.query(entry.id,
+                         entry.author_id,
+                         entry.changed_on,
+                         last_comment,
+                         stamp('entry:' + cast(entry.id, String)),
+                         stamp('author:' + cast(entry.author_id, String)),
+                         stamp('config'),
+                         stamp('sidebar'),
+                         next_transition_query(now).as_scalar())\
+          .filter(entry.slug == slug)
+    if not is_preview:
+        q = q.filter(entry.public == True)
+    return q.first()
+
+def entries(is_preview, catslug=None, start=None, page_size=None, archivable=True,
+            older_than=None, newer_than=None, profile=None):
+    """Entries ordered from the newest to the oldest,
+    loaded according to the loading ``profile``.
 
-def entries(is_preview, catslug=None, start=None, page_size=None, archivable=True):
+    ``older_than`` and ``newer_than`` are keys of the form ``(created, id)``
+    (see ``utils.decode_cursor``), used for keyset pagination.
+    With ``newer_than``, the order is reversed (oldest first), so that
+    ``page_size`` selects the entries closest to the key."""
     now = datetime.datetime.utcnow()
-    q = db.session.query(Entry)\
-         .order_by(Entry.created.desc())
+    q = with_profile(db.session.query(Entry), profile)
+
+    if newer_than is not None:
+        q = q.filter(tuple_(Entry.created, Entry.id) > tuple_(*newer_than))\
+             .order_by(Entry.created.asc(), Entry.id.asc())
+    else:
+        q = q.order_by(Entry.created.desc(), Entry.id.desc())
+    if older_than is not None:
+        q = q.filter(tuple_(Entry.created, Entry.id) < tuple_(*older_than))
 
     if not is_preview:
-        q = q.filter( Entry.public == True,
-                      ((Entry.since == None) | (Entry.since <= now)),
-                      ((Entry.until == None) | (Entry.until >= now)))
+        q = q.filter(publicly_visible(now))
     if catslug:
-        q = q.filter(Entry.category.has(slug=catslug))
+        # Comparing the ``category_id`` with a subquery (evaluated once)
+        # lets the planner use the ``(category_id, created, id)`` index.
+        category_id = db.session.query(Category.id)\
+            .filter(Category.slug == catslug)\
+            .as_scalar()
+        q = q.filter(Entry.category_id == category_id)
     if archivable:
         q = q.filter_by(archivable=True)
     if start != None:
@@ -72,6 +339,209 @@ def entries(is_preview, catslug=None, start=None, page_size=None, archivable=Tru
         q = q.limit(page_size)
     return q
 
+# The ``ix_entry_since`` and ``ix_entry_until`` indexes turn each
+# subquery below into a single index lookup.
+def next_transition_query(now):
+    next_since = db.session.query(func.min(Entry.since))\
+        .filter(Entry.since > now)\
+        .as_scalar()
+    next_until = db.session.query(func.min(Entry.until))\
+        .filter(Entry.until > now)\
+        .as_scalar()
+    # ``least`` ignores NULLs
+    return db.session.query(func.least(next_since, next_until))
+
+def next_transition(now):
+    """The first moment after ``now`` at which the ``since``/``until``
+    window of an entry opens or closes, or ``None`` if there is none.
+
+    Anything built from visible entries stays valid until then."""
+    return next_transition_query(now).scalar()
+
+def entries_page(is_preview, page_size, **kwargs):
+    """Returns ``(entries, has_more)``, where ``entries`` is a list of at most
+    ``page_size`` entries, newest first, and ``has_more`` tells whether there
+    are more entries in the direction we are paginating.
+
+    It fetches a single extra row instead of counting the entries.
+    Takes the same keyword arguments as ``entries``."""
+    rows = entries(is_preview, page_size=page_size + 1, **kwargs).all()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if kwargs.get('newer_than') is not None:
+        rows.reverse()
+    return rows, has_more
+
+def entry_keys(is_preview, **kwargs):
+    return entries(is_preview, **kwargs)\
+        .with_entities(Entry.created, Entry.id)
+
+def entry_key_at(is_preview, position, **kwargs):
+    """The ``(created, id)`` key of the entry at ``position``
+    (counting from 0), or ``None``.
+
+    Translates page numbers into keys. Only the key columns are read,
+    so the skipped rows are cheap."""
+    return entry_keys(is_preview, start=position, page_size=1, **kwargs)\
+        .first()
+
+# Summary tables (``TagCount``, ``ArchiveMonth``) hold counts of visible
+# entries. Their rows are deleted whenever the entries change (see
+# ``models.invalidate_summaries``) and expire at ``valid_until``, the
+# next time the ``since``/``until`` window of a counted entry opens or
+# closes. When they were last rebuilt is recorded in ``SummaryRefresh``,
+# so that an empty summary is fresh too.
+#
+# They are rebuilt on demand with a single aggregate query, in a
+# transaction of their own on the primary database: rebuilding them must
+# not commit (or roll back) the session of the request, and must not
+# count the entries of a replica that lags behind. The request uses the
+# counts it has just computed, which its replica may not have yet.
+
+def next_transitions(now):
+    """Aggregate columns with the next time a window opens and the
+    next time a window closes, to be added to the counting queries"""
+    return [func.min(case([(Entry.since > now, Entry.since)])),
+            func.min(case([(Entry.until > now, Entry.until)]))]
+
+def valid_until(rows):
+    """The earliest transition in ``rows``, whose last two columns
+    come from ``next_transitions``"""
+    transitions = [t for row in rows for t in row[-2:] if t is not None]
+    return min(transitions) if transitions else None
+
+def is_stale(model, now):
+    refresh = db.session.query(SummaryRefresh).get(model.__table__.name)
+    return refresh is None or \
+        (refresh.valid_until is not None and refresh.valid_until <= now)
+
+def refresh_summary(model, counting_query, make_rows, now):
+    """Rebuilds the summary table ``model`` from the rows of
+    ``counting_query``, converted by ``make_rows(rows, valid_until)``
+    to a list of ``dict``s, which is returned.
+
+    The table is only rebuilt if nobody is writing to the entries or
+    rebuilding it at the same time (see ``models.SUMMARY_LOCK``).
+    Otherwise the counts are returned without being stored."""
+    table = model.__table__
+    refresh = SummaryRefresh.__table__
+    connection = db.get_engine(app).connect()
+    try:
+        with connection.begin():
+            locked = connection.execute(
+                text("SELECT pg_try_advisory_xact_lock(:key)"),
+                key=SUMMARY_LOCK).scalar()
+            # Counted after taking the lock, so that the counts include
+            # the changes of every writer that held it before
+            rows = connection.execute(counting_query.statement).fetchall()
+            until = valid_until(rows)
+            summary = make_rows(rows, until)
+            if locked:
+                connection.execute(table.delete())
+                connection.execute(refresh.delete().where(refresh.c.name == table.name))
+                if summary:
+                    connection.execute(table.insert(), summary)
+                connection.execute(refresh.insert().values(name=table.name,
+                                                           refreshed_at=now,
+                                                           valid_until=until))
+    finally:
+        connection.close()
+    return summary
+
+def refresh_tag_counts(now):
+    window = in_time_window(now)
+    counting = db.session.query(
+            assoc_entry_tag.c.tag_id,
+            func.sum(case([(and_(Entry.public == True, window), 1)], else_=0)),
+            func.sum(case([(window, 1)], else_=0)),
+            *next_transitions(now))\
+        .join(Entry, Entry.id == assoc_entry_tag.c.entry_id)\
+        .group_by(assoc_entry_tag.c.tag_id)
+
+    def make_rows(rows, until):
+        return [dict(tag_id=tag_id,
+                     public_count=public_count,
+                     preview_count=preview_count,
+                     valid_until=until)
+                for (tag_id, public_count, preview_count, _, _) in rows]
+    return refresh_summary(TagCount, counting, make_rows, now)
+
+def tag_counts(is_preview):
+    """Returns pairs of the form (*tag*, *number of visible entries*),
+    leaving out tags without visible entries."""
+    now = datetime.datetime.utcnow()
+    column = 'preview_count' if is_preview else 'public_count'
+    if is_stale(TagCount, now):
+        counts = dict((row['tag_id'], row[column])
+                      for row in refresh_tag_counts(now) if row[column] != 0)
+        tags = []
+        if counts:
+            tags = db.session.query(Tag)\
+                .filter(Tag.id.in_(counts.keys()))\
+                .order_by(Tag.name.asc())
+        pairs = [(tag, counts[tag.id]) for tag in tags]
+    else:
+        rows = db.session.query(TagCount, Tag)\
+            .join(Tag, Tag.id == TagCount.tag_id)\
+            .order_by(Tag.name.asc())
+        pairs = [(tag, getattr(count, column)) for (count, tag) in rows]
+    return [(tag, count) for (tag, count) in pairs if count != 0]
+
+def refresh_archive_months(now):
+    year = extract('year', Entry.created)
+    month = extract('month', Entry.created)
+    counting = db.session.query(
+            year, month,
+            func.sum(case([(and_(Entry.public == True,
+                                 in_time_window(now)), 1)], else_=0)),
+            func.count(Entry.id),
+            *next_transitions(now))\
+        .filter(Entry.archivable == True)\
+        .group_by(year, month)
+
+    def make_rows(rows, until):
+        return [dict(year=int(year),
+                     month=int(month),
+                     public_count=public_count,
+                     preview_count=preview_count,
+                     valid_until=until)
+                for (year, month, public_count, preview_count, _, _) in rows]
+    return refresh_summary(ArchiveMonth, counting, make_rows, now)
+
+def archive_months(is_preview):
+    """Returns triples of the form (*year*, *month*, *number of entries*)
+    for the months with entries in the archives, newest first."""
+    now = datetime.datetime.utcnow()
+    column = 'preview_count' if is_preview else 'public_count'
+    if is_stale(ArchiveMonth, now):
+        triples = [(m['year'], m['month'], m[column])
+                   for m in refresh_archive_months(now)]
+    else:
+        triples = [(m.year, m.month, getattr(m, column))
+                   for m in db.session.query(ArchiveMonth)]
+    return sorted([t for t in triples if t[2] != 0], reverse=True)
+
+def archive_entries(is_preview, year=None):
+    """The archivable entries, newest first, as light rows with only
+    the columns the archives show.
+
+    ``visible`` tells whether the entry is visible in the *public*
+    version. The rows are fetched with a server-side cursor, a few at
+    a time, so that they can be streamed."""
+    now = datetime.datetime.utcnow()
+    public_and_live = publicly_visible(now)
+    q = db.session.query(Entry.id, Entry.slug, Entry.title, Entry.created,
+                         case([(public_and_live, True)], else_=False)\
+                             .label('visible'))\
+        .filter(Entry.archivable == True)\
+        .order_by(Entry.created.desc(), Entry.id.desc())
+
+    if not is_preview:
+        q = q.filter(public_and_live)
+    if year is not None:
+        q = q.filter(Entry.created >= datetime.datetime(year, 1, 1),
+                     Entry.created < datetime.datetime(year + 1, 1, 1))
+    return q.execution_options(stream_results=True).yield_per(100)
 
 def sidebar_modules():
     return db.session.query(SidebarModule).\
@@ -0,0 +1,57 @@
+from flask import g, has_request_context
+from flask.ext.appbuilder import SQLA
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.sql.expression import UpdateBase
+from functools import partial
+
+from pool import pool_options
+
+# Read replicas are configured as Flask-SQLAlchemy binds
+# (``SQLALCHEMY_BINDS``, see ``config.READ_REPLICAS``). No model is
+# mapped to them: the session below decides, for each statement,
+# whether it goes to the primary database or to a replica.
+#
+# A request chooses a replica by setting ``g.read_replica`` to the name
+# of its bind (see ``routes.choose_replica``). Only read-only requests
+# do so. Even then, writes (for example, when a summary table is
+# refreshed) go to the primary, and after the first write the rest of
+# the request reads from the primary too, so it sees what it wrote.
+
+class RoutingSession(SignallingSession):
+
+    def __init__(self, db, **options):
+        self.routing_db = db
+        # Whether this session has written to the primary
+        self.wrote = False
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.wrote = True
+        elif not self.wrote:
+            replica = read_replica()
+            if replica is not None:
+                return self.routing_db.get_engine(self.app, bind=replica)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+def read_replica():
+    """The bind name of the replica chosen by the current request, if any"""
+    if not has_request_context():
+        return None
+    return getattr(g, 'read_replica', None)
+
+class RoutingSQLA(SQLA):
+    """``SQLA`` whose sessions can send reads to replicas,
+    and whose engines keep pool statistics (see ``pool``)"""
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLA.apply_driver_hacks(self, app, info, options)
+        options.update(pool_options(app))
+
+    def create_scoped_session(self, options=None):
+        if options is None:
+            options = {}
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(partial(RoutingSession, self, **options),
+                                  scopefunc=scopefunc)
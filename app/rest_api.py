@@ -1,10 +1,11 @@
 from app import app, db, appbuilder, csrf
 from models import Entry, Author, Tag, Category, SidebarModule
+from pool import pool_stats
 import query
 
 from werkzeug import secure_filename
 import flask.json as json
-from flask import request, make_response
+from flask import request, make_response, send_from_directory
 
 from flask.ext.appbuilder import has_access, expose, BaseView
 from flask.ext.login import login_user
@@ -78,6 +79,19 @@ class ClientApi(BaseView):
 
 
 
+    # Connection pool statistics of this process (see ``pool.PoolStats``)
+    @has_access
+    @expose('/stats/pool/', methods=['GET'])
+    def pool(self):
+        return json.jsonify(pool_stats(db, app))
+
+    # Profiles of single requests (see ``profiler``)
+    @has_access
+    @expose('/profiles/<filename>', methods=['GET'])
+    def profile(self, filename):
+        return send_from_directory(app.config['PROFILE_DIR'], filename,
+                                   as_attachment=True)
+
     @csrf.exempt
     @has_access
     @expose('/entry/', methods=['GET', 'PUT', 'POST', 'DELETE'])
@@ -1,86 +1,320 @@
 # Flask:
 from flask import render_template, redirect, abort, url_for,\
-  g, session, request, flash
+  g, session, request, flash, Markup, Response, stream_with_context, jsonify,\
+  make_response
 
-from werkzeug.contrib.atom import AtomFeed
+from werkzeug.contrib.atom import AtomFeed, FeedEntry
 
 # Flask extensions:
 from flask.ext.appbuilder import BaseView, expose, has_access, permission_name
+from flask_wtf.csrf import generate_csrf
 from flask_appbuilder.security.models import User, Role
 
 from sqlalchemy_searchable import search
+from sqlalchemy.orm import joinedload
 # Standard Library:
 import os
 import itertools
 import datetime
+import calendar
+import hashlib
+import random
+import time
 
 # Flog modules:
 from app import app, db, appbuilder, akis
 from models import Entry, Comment, Category, Tag
-from utils import sanitize_plaintext, sanitize_richtext
+from utils import sanitize_plaintext, sanitize_richtext, encode_cursor, decode_cursor,\
+  encode_search_cursor, decode_search_cursor
 from forms import EditCommentForm, NewCommentForm, SearchForm
+from cache import fragments, feeds, searches
+from page_cache import cached_page, depends_on, hole_renderer, is_fresh
+from sessions import is_cookieless
 import query
 
 
+# The ``ETag`` of the page of an entry (see ``SiteView.entry``).
+# It is weak, because the page may be sent gzipped or not.
+def entry_etag(page_version, validator):
+    user = g.user.get_id() if g.user.is_authenticated() else None
+    return hashlib.sha1(repr((page_version, user) + tuple(validator))).hexdigest()
+
 # A function that builds a HTML anchor <link>
 # to the comment with id ``comment_id``
 def comment_anchor_id(comment_id):
     return "comment-id-{}".format(comment_id)
 
+# Renders a template a few chunks at a time, sending each chunk to the
+# client as soon as it is ready, instead of building the whole page in
+# memory (see "Streaming from Templates" in the Flask docs).
+def stream_template(template_name, **context):
+    # A page that is going to be cached must be complete
+    # (see ``page_cache``)
+    if getattr(g, 'page_holes', None) is not None:
+        return render_template(template_name, **context)
+    # The navbar and the sidebar may need queries (and refresh the
+    # summary tables): they are rendered before the stream starts, so
+    # that the server-side cursor of the page is the only query running
+    # on the connection while the page streams.
+    cls = context['cls']
+    context['navbar_html'] = cls.navbar_html(context.get('active_category'),
+                                             context.get('is_all', False),
+                                             context.get('is_archives', False))
+    context['sidebar_html'] = cls.sidebar_html()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(5)
+    # Keep the request context (and the DB cursor) alive while streaming
+    return Response(stream_with_context(stream))
+
+# Read-only public pages and the feeds read from a random replica, if there
+# are any, unless the visitor wrote something a moment ago (see ``replicas``)
+def choose_replica():
+    replicas = app.config['READ_REPLICAS']
+    if not replicas or request.method not in ['GET', 'HEAD'] or \
+            not is_public_endpoint(request.endpoint):
+        return None
+    wrote_at = session.get('wrote_at')
+    if wrote_at and time.time() - wrote_at < app.config['REPLICA_STICKINESS']:
+        return None
+    return random.choice(replicas)
+
+# Static files don't need the database (see ``static_files``)
+def is_static_endpoint(endpoint):
+    return endpoint is not None and \
+        (endpoint == 'static' or endpoint.endswith('.static'))
+
 @app.before_request
 def before_request():
-    # Prepare session:
-    try:
-        session['comments']
-    except:
-        session['comments'] = []
-    session.permanent = True
-
-    g.blog_config = query.blog_config()
-    g.search_form = SearchForm()
-
+    if is_static_endpoint(request.endpoint):
+        return
+    # Must be chosen before the first query
+    g.read_replica = choose_replica()
+
+    # The version stamps the response depends on (see ``page_cache``)
+    g.page_deps = set(['config'])
+    # A cached page or feed is served without reading or writing the session
+    cached = cached_page()
+    if cached is None:
+        cached = stored_feed()
+    if cached is not None:
+        return cached
+
+    # The session is only written when a reader posts a comment
+    # (see ``sessions``): readers don't get a cookie just for reading.
+    # Logged in users keep their session when they close the browser,
+    # as do readers who have commented (see ``SiteView.entry``).
+    if g.user.is_authenticated():
+        session.permanent = True
+    g.versions = query.versions(['config', 'sidebar', 'entries', 'comments'])
+    g.blog_config = query.blog_config(g.versions['config'])
+    # Searching doesn't change anything, so the search form is a GET form
+    # without a CSRF token, the same for every reader
+    g.search_form = SearchForm(csrf_enabled=False)
+
+
+# Endpoints whose responses are the same for every anonymous reader
+def is_public_endpoint(endpoint):
+    return endpoint is not None and \
+        (endpoint.startswith('PublicView.') or
+         endpoint in ['atom_feed_entries', 'atom_feed_comments'])
+
+@app.after_request
+def add_cache_headers(response):
+    # Public pages only change when someone writes to the DB or when an
+    # entry appears or disappears. The second case is predictable, so we
+    # can tell clients exactly how long a page stays valid.
+    #
+    # Responses to readers without a session are the same for everyone,
+    # and shared caches (a reverse proxy) may keep them for
+    # ``PUBLIC_S_MAXAGE`` seconds. The others are private.
+    max_age = app.config.get('PUBLIC_MAX_AGE', 0)
+    s_maxage = app.config.get('PUBLIC_S_MAXAGE', 0)
+    # A ``304 Not Modified`` renews the cached response, and must carry
+    # the same headers
+    if not (max_age or s_maxage) or request.method not in ['GET', 'HEAD'] or \
+            response.status_code not in [200, 304] or \
+            not is_public_endpoint(request.endpoint):
+        return response
+    response.vary.add('Cookie')
+    if g.user.is_authenticated() or not is_cookieless(app, session):
+        response.cache_control.private = True
+        return response
 
-@app.route('/atom-feed-entries')
-def atom_feed_entries():
     now = datetime.datetime.utcnow()
+    # Pages served from the cache know when the next transition is
+    if hasattr(g, 'next_transition'):
+        transition = g.next_transition
+    else:
+        transition = query.next_transition(now)
+    def seconds(max_age):
+        if transition is None:
+            return max_age
+        return max(0, min(max_age, int((transition - now).total_seconds())))
+    response.cache_control.public = True
+    response.cache_control.max_age = seconds(max_age)
+    # A page served by the page cache without checking the version stamps
+    # may be older than the last purge of the proxy (see ``purge``)
+    if getattr(g, 'page_unchecked', False):
+        response.cache_control.s_maxage = 0
+    elif s_maxage:
+        response.cache_control.s_maxage = seconds(s_maxage)
+    if max_age:
+        response.expires = now + datetime.timedelta(seconds=seconds(max_age))
+    return response
+
+@app.after_request
+def remember_writes(response):
+    # Read your own writes: see ``choose_replica``
+    if app.config['READ_REPLICAS'] and \
+            request.method not in ['GET', 'HEAD'] and db.session().wrote:
+        session['wrote_at'] = time.time()
+    return response
+
+
+# The Atom feeds are polled constantly by feed readers, but only change
+# when an entry or a comment is written (or when an entry appears or
+# disappears). They are built once, stored as bytes and served with a
+# strong ``ETag`` and a ``Last-Modified`` date, so that most polls are
+# answered with ``304 Not Modified``.
+#
+# A stored feed is checked like a cached page (see ``page_cache.is_fresh``),
+# in ``before_request``, before anything else reads the DB: its
+# ``'config'`` and ``stamp`` version stamps are compared with the current
+# ones, except for ``PAGE_CACHE_TRUST`` seconds after the last check, when
+# the poll is answered without any query. The feed expires at the next
+# transition.
+#
+# ``Last-Modified`` is the time the feed was built, not the date of its
+# newest item: removing an entry or a comment from the feed changes it
+# without adding anything newer. Each process builds its own copy, so the
+# date differs between the workers. The ``ETag`` comes from the contents,
+# and takes precedence for the clients that send it.
+
+# The version stamp of each feed, besides ``'config'``
+FEED_STAMPS = {
+    'atom_feed_entries': 'entries',
+    'atom_feed_comments': 'comments',
+}
+
+class CachedFeed(object):
+    def __init__(self, body, versions, expires):
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.last_modified = datetime.datetime.utcnow().replace(microsecond=0)
+        # The version stamps the feed was built with
+        self.versions = versions
+        self.checked_at = time.time()
+        # The next ``since``/``until`` transition, when the feed expires
+        self.expires = expires
+
+def feed_key():
+    # The feeds read no query arguments: they must not make new entries
+    return (request.endpoint, request.base_url)
+
+def feed_response(feed):
+    depends_on(*feed.versions)
+    g.next_transition = feed.expires
+    response = Response(feed.body, mimetype='application/atom+xml')
+    response.set_etag(feed.etag)
+    response.last_modified = feed.last_modified
+    return response.make_conditional(request)
+
+def stored_feed():
+    """The response for the current request from the stored feed,
+    or ``None`` if the request is not for a feed or the feed has changed"""
+    if request.endpoint not in FEED_STAMPS or \
+            request.method not in ['GET', 'HEAD']:
+        return None
+    feed = feeds.get(feed_key())
+    if feed is None or not is_fresh(feed):
+        return None
+    return feed_response(feed)
+
+def cached_feed(build):
+    """Builds the feed of the current request with ``build``, which
+    returns the serialized feed, and stores it"""
+    stamp = FEED_STAMPS[request.endpoint]
+    versions = {'config': g.versions['config'], stamp: g.versions[stamp]}
+    expires = query.next_transition(datetime.datetime.utcnow())
+    feed = feeds.set(feed_key(), CachedFeed(build(), versions, expires), expires)
+    return feed_response(feed)
+
+def build_entries_feed():
     config = g.blog_config
     title = config.blog_title + " Entries"
     subtitle = config.blog_subtitle
-    feed = AtomFeed(title, feed_url=request.url,
+    feed = AtomFeed(title, feed_url=request.base_url,
                     url=request.host_url,
                     subtitle=subtitle)
 
-
-    for entry in query.entries(False, page_size=config.entries_in_feed).all():
+    for entry in query.entries(False, page_size=config.entries_in_feed,
+                                profile='feed').all():
         feed.add(entry.title, entry.lead + entry.content, content_type='html',
                  author=entry.author.name,
                  url=url_for('PublicView.entry', slug=entry.slug),
                  id=entry.id,
                  updated=entry.created,
                  published=entry.created)
-    return feed.get_response()
+    return feed.to_string().encode('utf-8')
 
-@app.route('/atom-feed-comments')
-def atom_feed_comments():
-    now = datetime.datetime.utcnow()
+def build_comments_feed():
     config = g.blog_config
     title = config.blog_title + " Comments"
     subtitle = "Responses from the readers"
-    feed = AtomFeed(title, feed_url=request.url,
+    # Admins may ask for thousands of comments. The rows arrive a few
+    # at a time, and each one is serialized as soon as it arrives,
+    # instead of building all the ``FeedEntry`` objects first.
+    rows = iter(query.feed_comments(config.comments_in_feed))
+    # The rows are ordered by date, so the first one is the newest.
+    newest = next(rows, None)
+    feed = AtomFeed(title, feed_url=request.base_url,
                     url=request.host_url,
-                    subtitle=subtitle)
+                    subtitle=subtitle,
+                    updated=newest.published if newest else None)
+
+    # A feed without entries: everything but the closing tag comes
+    # before the entries.
+    head = list(feed.generate())
+    body = [part.encode('utf-8') for part in head[:-1]]
+    if newest is not None:
+        for comment in itertools.chain([newest], rows):
+            entry = FeedEntry(comment.name, comment.content, content_type='html',
+                              author=comment.name,
+                              url=url_for('PublicView.entry',
+                                          slug=comment.slug,
+                                          _anchor=comment_anchor_id(comment.id)),
+                              id=comment.id,
+                              updated=comment.published,
+                              published=comment.published,
+                              feed_url=request.base_url)
+            body.extend((u'  ' + line).encode('utf-8')
+                        for line in entry.generate())
+    body.append(head[-1].encode('utf-8'))
+    return ''.join(body)
 
-    for comment in db.session.query(Comment)\
-                       .limit(config.comments_in_feed).all():
-        feed.add(comment.name, comment.content, content_type='html',
-                 author=comment.name,
-                 url=url_for('PublicView.entry',
-                             slug=comment.entry.slug,
-                             _anchor=comment_anchor_id(comment.id)),
-                 id=comment.id,
-                 updated=comment.published,
-                 published=comment.published)
-    return feed.get_response()
+@app.route('/atom-feed-entries')
+def atom_feed_entries():
+    # Entries appear and disappear with time, so the feed expires
+    # at the next transition.
+    return cached_feed(build_entries_feed)
+
+@app.route('/atom-feed-comments')
+def atom_feed_comments():
+    # Comments disappear with their entries, so this feed
+    # expires at the next transition too
+    return cached_feed(build_comments_feed)
+
+# The CSRF token of the form for new comments. It is fetched by the page
+# only when the reader starts writing a comment (see
+# ``new-comment-script.html``): generating it starts a session, and
+# readers who don't comment must not get a session cookie (see ``sessions``).
+@app.route('/comment-csrf-token')
+def comment_csrf_token():
+    response = jsonify(csrf_token=generate_csrf())
+    response.cache_control.no_store = True
+    return response
 
 
 # The class SiteView represents the set of routes in our blog.
@@ -138,7 +372,8 @@ class SiteView(BaseView):
     def recent_entries(self):
         max_entries = g.blog_config.entries_in_sidebar
         now = datetime.datetime.utcnow()
-        recent_entries = query.entries(self.is_preview, page_size=max_entries)
+        recent_entries = query.entries(self.is_preview, page_size=max_entries,
+                                       profile='archive')
         return recent_entries
 
 
@@ -147,17 +382,7 @@ class SiteView(BaseView):
         The method is aware of the page version (*public* or *private*),
         and will only show the number of entries that are available in
         that version"""
-
-        # There should be a more "SQLy" way of doing this
-        tags = db.session.query(Tag)
-        #pairs = [(tag, len([entry for entry in tag.entries
-        #                      if entry.is_visible(self.is_preview)]))
-        #         for tag in tags]
-        pairs = [(tag, tag.nr_of_visible_entries(self.is_preview))
-                   for tag in tags]
-
-        # Only show tags that have at least one entry:
-        return [(tag, count) for (tag, count) in pairs if count != 0]
+        return query.tag_counts(self.is_preview)
 
     def sidebar_modules(self):
         return query.sidebar_modules().all()
@@ -165,45 +390,139 @@ class SiteView(BaseView):
     def categories(self):
         return query.categories().all()
 
+    # The sidebar and the navbar tabs are identical on every page
+    # of the same version of the site, so they are rendered once and
+    # cached. The cache key contains the ``'config'`` and ``'sidebar'``
+    # version stamps, which are bumped whenever an ``Entry``, ``Tag``,
+    # ``Category`` or ``SidebarModule`` changes (see ``models``).
+    #
+    # The sidebar also depends on the time, because entries appear
+    # and disappear according to their ``since`` and ``until`` dates.
+    # With ``expiring=True``, the fragment expires at the next of those
+    # transitions.
+    def cached_fragment(self, template, expiring=False, **context):
+        depends_on('sidebar')
+        key = (template, self.page_version,
+               g.versions['config'], g.versions['sidebar'],
+               tuple(sorted(context.items())))
+        now = datetime.datetime.utcnow()
+        html = fragments.get(key, now)
+        if html is None:
+            expires = query.next_transition(now) if expiring else None
+            html = Markup(render_template(template, cls=self, **context))
+            fragments.set(key, html, expires)
+        return html
+
+    def sidebar_html(self):
+        return self.cached_fragment('sidebar-modules.html', expiring=True)
+
+    def navbar_html(self, active_category, is_all, is_archives):
+        return self.cached_fragment('navbar-tabs.html',
+                                    active_category=active_category,
+                                    is_all=is_all,
+                                    is_archives=is_archives)
+
     @permission_name('view_blog')
-    @expose('/search', methods=['POST'])
+    @expose('/search')
     def search(self):
-        if not g.search_form.validate_on_submit():
+        form = SearchForm(request.args, csrf_enabled=False)
+        if not form.validate():
             return redirect(url_for('index'))
         return redirect(self.url_for('search_results_entries',
-            search_query=g.search_form.search.data))
+            search_query=form.search.data))
 
 
+    # Pages of search results are cached. The key contains the normalized
+    # query and the ``'entries'`` version stamp, which is bumped whenever
+    # an ``Entry`` changes. A page also expires at the next ``since``/``until``
+    # transition, when entries appear and disappear.
     @permission_name('view_blog')
     @expose('/search-results/entries/<search_query>')
-    def search_results_entries(self, search_query):
+    @expose('/search-results/entries/<search_query>/<cursor>')
+    def search_results_entries(self, search_query, cursor=None):
         now = datetime.datetime.utcnow()
-        sql_q = query.entries(self.is_preview, archivable=False)
-        entries = search(sql_q, search_query.lower())
+        page_size = g.blog_config.entries_per_page
+        after = None
+        if cursor is not None:
+            try:
+                after = decode_search_cursor(cursor)
+            except ValueError:
+                return abort(404)
+
+        depends_on('entries')
+        normalized_query = u' '.join(search_query.lower().split())
+        key = (self.page_version, normalized_query, after,
+               g.versions['config'], g.versions['entries'])
+        cached = searches.get(key, now)
+        if cached is None:
+            expires = query.next_transition(now)
+            # One extra row tells us whether there is a next page
+            rows = query.search_entries(self.is_preview, normalized_query,
+                                        page_size + 1, after).all()
+            cached = searches.set(key, (rows[:page_size], len(rows) > page_size),
+                                  expires)
+        results, has_more = cached
+
+        if has_more:
+            more = dict(search_query=search_query,
+                        cursor=encode_search_cursor(results[-1]))
+        else:
+            more = None
+
+        # Nothing found: maybe a typo
+        if not results and after is None:
+            suggestion = query.did_you_mean(self.is_preview, normalized_query)
+        else:
+            suggestion = None
 
-        # It won't need pagination for now
         return render_template('search-results-entries.html',
             search_query=search_query,
-            entries=entries,
+            entries=results,
+            more=more,
+            suggestion=suggestion,
             cls=self)
 
+    # Suggestions for the search box, as the reader types
+    # (see ``query.suggestions``). They are cached like the results.
+    @permission_name('view_blog')
+    @expose('/search-suggestions')
+    def search_suggestions(self):
+        text = u' '.join(request.args.get('q', u'').lower().split())
+        if len(text) < app.config['SEARCH_SUGGESTIONS_MIN_LENGTH']:
+            return jsonify(suggestions=[])
+
+        depends_on('entries', 'sidebar')
+        now = datetime.datetime.utcnow()
+        key = ('suggestions', self.page_version, text,
+               g.versions['entries'], g.versions['sidebar'])
+        suggestions = searches.get(key, now)
+        if suggestions is None:
+            expires = query.next_transition(now)
+            rows = query.suggestions(self.is_preview, text,
+                                     app.config['SEARCH_SUGGESTIONS'])
+            suggestions = []
+            for (kind, title, slug) in rows:
+                if kind == 'entry':
+                    url = self.url_for('entry', slug=slug)
+                else:
+                    url = self.url_for('tag', tag_slug=slug)
+                suggestions.append(dict(kind=kind, title=title, url=url))
+            searches.set(key, suggestions, expires)
+        return jsonify(suggestions=suggestions)
+
     @permission_name('view_blog')
     @expose('/search-results/comments/<search_query>')
     def search_results_comments(self, search_query):
-        now = datetime.datetime.utcnow()
-        sql_q = db.session.query(Comment)
+        depends_on('comments', 'entries')
+        # The template shows the title of the entry of each comment
+        sql_q = db.session.query(Comment)\
+            .options(joinedload(Comment.entry).load_only('slug', 'title'))
         comments = search(sql_q, search_query.lower())
 
-        # The edit lag is the time the user has to edit the comment after the submission.
-        # By deafult, it is 15 minutes, but can be configured by the Admin.
-        edit_lag = g.blog_config.edit_lag()
-        # get the editable comments from the DB, based on their publication date
-        editable_cmts = editable_comments(edit_lag, session)
         # It won't need pagination for now
         return render_template('search-results-comments.html',
             search_query=search_query,
             comments=comments,
-            editable_comments=editable_cmts,
             comment_anchor_id=comment_anchor_id,
             cls=self)
 
@@ -217,12 +536,14 @@ class SiteView(BaseView):
     @permission_name('view_blog')
     @expose('/archives/')
     def archives(self):
-        now = datetime.datetime.utcnow()
-        entries = query.entries(self.is_preview)
+        depends_on('entries')
+        # Only the columns the page shows are fetched, a few rows at a time,
+        # and the page is sent while the rows arrive.
+        entries = query.archive_entries(self.is_preview)
 
         # Group the entries by year:
         grouping = itertools.groupby(entries, lambda entry: entry.created.year)
-        return render_template("archives.html",
+        return stream_template("archives.html",
                 title="Archives",
                 grouping=grouping,
                 # We have to tell th template that we are rendering the
@@ -234,14 +555,46 @@ class SiteView(BaseView):
                 # the correct endpoint.
                 cls=self)
 
+    @has_access
+    @permission_name('view_blog')
+    @expose('/archives/<int:year>/')
+    # The entries of a single year, grouped by month.
+    #
+    # The number of entries of each month comes from a precomputed
+    # index (see ``query.archive_months``), so that we know which years
+    # exist without going through the entries.
+    def archives_year(self, year):
+        depends_on('entries')
+        months = query.archive_months(self.is_preview)
+        month_counts = dict((month, count)
+                            for (y, month, count) in months if y == year)
+        if not month_counts:
+            return abort(404)
+        years = sorted(set(y for (y, _, _) in months), reverse=True)
+
+        entries = query.archive_entries(self.is_preview, year=year)
+        grouping = itertools.groupby(entries, lambda entry: entry.created.month)
+        return stream_template("archives-year.html",
+                title="Archives: {}".format(year),
+                year=year,
+                years=years,
+                month_counts=month_counts,
+                month_names=calendar.month_name,
+                grouping=grouping,
+                is_archives=True,
+                cls=self)
+
     @has_access
     @permission_name('view_blog')
     @expose('/tag/<tag_slug>')
     # List all entries with a certain tag
     def tag(self, tag_slug):
         tag = db.session.query(Tag).filter_by(slug=tag_slug).first()
+        if tag is None:
+            return abort(404)
+        depends_on('tag:{}'.format(tag.id), 'entries', 'comments')
 
-        entries = db.session.query(Entry)\
+        entries = query.with_profile(db.session.query(Entry), 'summary')\
             .filter(Entry.tags.contains(tag))\
             .order_by(Entry.created.desc())
 
@@ -272,6 +625,26 @@ class SiteView(BaseView):
         # to "focus" the webpage. If the Anchor is ``None``
         # the browser simply displays the page from the beginning.
         anchor = None
+
+        # A reader who reloads an unchanged page gets ``304 Not Modified``
+        # after a single cheap query, before the entry and its comments
+        # are loaded. Readers who have comments to edit see "Edit" links
+        # that depend on the time, so they always get the whole page.
+        etag = None
+        if request.method == 'GET' and edit_id is None and \
+                not session.get('comments') and not session.get('_flashes'):
+            validator = query.entry_validator(slug, self.is_preview,
+                                              datetime.datetime.utcnow())
+            if not validator:
+                return abort(404)
+            depends_on('entry:{}'.format(validator.id),
+                       'author:{}'.format(validator.author_id))
+            etag = entry_etag(self.page_version, validator)
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag, weak=True)
+                return response
+
         # Get entry from database
         # The complexity of deciding whether the page is acessible
         # from the current view is delegated to the ``query`` module.
@@ -280,12 +653,14 @@ class SiteView(BaseView):
         # What decides whether the entry can be shown or not is the
         # SiteView subclass. User permissions only restrict the user
         # based on routes!
-        _entry = query.entry(slug, self.is_preview)
+        _entry = query.entry(slug, self.is_preview, profile='detail')
         if not _entry:
             # 404 is the "Not Found" error
             return abort(404)
 
         entry_id = _entry.id
+        depends_on('entry:{}'.format(entry_id),
+                   'author:{}'.format(_entry.author_id))
         # Get all visible comment. By default, all spam comments are invisible.
         comments = query.comments(entry_id, visible_only=True).all()
 
@@ -300,7 +675,7 @@ class SiteView(BaseView):
         form_new = NewCommentForm(request.form, prefix="new")
 
         # If the user has just edited a comment:
-        if edit_id and edit_id in session.get('comments'):
+        if edit_id and edit_id in session.get('comments', []):
             # if the form has been submitted and validated, and has type ``'edit-comment'``:
             if form_edit.validate_on_submit() and form_edit.type.data == 'edit-comment':
                 update_comment(edit_id, form_edit)
@@ -340,17 +715,14 @@ class SiteView(BaseView):
                 # relieves us and the user from the hassle of managing
                 # and creating accounts for the blog.
                 else:
-                    session['comments'].append(comment.id)
+                    session['comments'] = session.get('comments', []) + [comment.id]
+                    session.permanent = True
                     return redirect(self.url_for('entry', slug=slug,
                         _anchor=comment_anchor_id(comment.id)))
 
-        # The edit lag is the time the user has to edit the comment after the submission.
-        # By deafult, it is 15 minutes, but can be configuref by the Admin.
-        edit_lag = g.blog_config.edit_lag()
-        # get the editable comments from the DB, based on their publication date
-        editable_cmts = editable_comments(edit_lag, session)
-
-        return render_template('entry-detail.html',
+        # The "Edit" links of the comments are rendered
+        # by ``comment_edit``, for each reader
+        response = make_response(render_template('entry-detail.html',
             entry=_entry,
             # The template needs to know ehat the active category is:
             active_category=_entry.category.slug,
@@ -358,12 +730,14 @@ class SiteView(BaseView):
             form_new=form_new, form_edit=form_edit,
             # we supply a function to generate anchors to the comments:
             comment_anchor_id=comment_anchor_id,
-            editable_comments=editable_cmts,
             now=now,
             # we supply the ID of the comment the user is editing, or ``None``
             # if the User hasn't edited or won't edit.
             edit_id=edit_id,
-            cls=self)
+            cls=self))
+        if etag is not None:
+            response.set_etag(etag, weak=True)
+        return response
 
 
     @has_access
@@ -375,49 +749,94 @@ class SiteView(BaseView):
         home_category = query.home_category()
         return redirect(self.url_for('category', catslug=home_category.slug))
 
+    # Entries are paginated with keyset (or "seek") pagination.
+    # Instead of counting the entries and skipping the previous pages
+    # with an ``OFFSET``, the links to the *older* and *newer* pages
+    # carry a *cursor*, the ``(created, id)`` key of the last entry the
+    # user has seen (see ``utils.encode_cursor``).
+    #
+    # The page number in the URL is only used to show "Page N".
+    # URLs without a cursor (``/category/<catslug>/<int:page>``) still
+    # work: the page number is translated into a cursor by reading
+    # only the key of the last entry of the previous page.
+    #
+    # Returns the entries and the URL arguments for the *older* and
+    # *newer* pages (``None`` if there is no such page).
+    def paginate(self, page, direction, cursor, **kwargs):
+        entries_per_page = g.blog_config.entries_per_page
+        older_than = None
+        newer_than = None
+
+        if cursor is not None:
+            try:
+                key = decode_cursor(cursor)
+            except ValueError:
+                return abort(404)
+            if direction == 'older':
+                older_than = key
+            else:
+                newer_than = key
+        elif page > 1:
+            older_than = query.entry_key_at(self.is_preview,
+                    (page - 1) * entries_per_page - 1, **kwargs)
+            if older_than is None:
+                return abort(404)
+
+        entries, has_more = query.entries_page(self.is_preview,
+                entries_per_page,
+                profile='list',
+                older_than=older_than,
+                newer_than=newer_than,
+                **kwargs)
+
+        # if there are no entries in the first page, we don't want to show
+        # an error, as it simply means the category is empty. Especially when
+        # adding entries from the command line, it might be useful to have
+        # temporarily empty categories
+        if not entries:
+            if older_than is not None or newer_than is not None:
+                return abort(404)
+            return entries, None, None
+
+        # Get the *next* (= ``newer``) and *previous* (= ``older``) pages:
+        # if there are no ``older`` or ``newer``` pages, set the corresponding
+        # value to ``None``. This will be used by the template.
+        if newer_than is not None or has_more:
+            older = dict(page=page + 1, direction='older',
+                         cursor=encode_cursor(entries[-1]))
+        else:
+            older = None
+
+        if older_than is None and not (newer_than is not None and has_more):
+            newer = None
+        elif page - 1 <= 1:
+            # The first page doesn't need a cursor
+            newer = dict()
+        else:
+            newer = dict(page=page - 1, direction='newer',
+                         cursor=encode_cursor(entries[0]))
+
+        return entries, older, newer
+
     @has_access
     @permission_name('view_blog')
     @expose('/category/<catslug>')
     @expose('/category/<catslug>/<int:page>')
+    @expose('/category/<catslug>/<int:page>/<any(older, newer):direction>/<cursor>')
     # List entries in a category. Entries are divided into pages according
     # to the configuration defined by the Admin user. Each page has
     # ``entries_per_page`` entries. Pages start countiing from 1, not 0.
     #
     # If ``page == 1``, the page number is optional.
-    def category(self, catslug, page=1):
-        now = datetime.datetime.utcnow()
+    def category(self, catslug, page=1, direction=None, cursor=None):
         category = db.session.query(Category).filter_by(slug=catslug).first()
         if not category:
             return abort(404)
+        depends_on('category:{}'.format(category.id), 'entries', 'comments')
 
-        entries_per_page = g.blog_config.entries_per_page
-        nr_of_entries = query.entries(self.is_preview, catslug, archivable=False).count()
-
-        # if nr_of_entries is = 0, we don't want to show an error, as it simply
-        # means the category is empty. Especially when adding entries from the command line,
-        # it might be useful to have temporarily empty entries
-        if nr_of_entries > 0 and (page-1)*entries_per_page >= nr_of_entries:
-            return abort(404)
-
-        # Get the entries (remember, page numbers start at 1!)
-        entries = query.entries(self.is_preview, catslug,
-                start=(page - 1) * entries_per_page,
-                page_size=entries_per_page,
-                archivable=False).all()
-
-
-        # Get the *next* (= ``newer``) and *previous* (= ``older``) pages:
-        # if there are no ``older`` or ``newer```pages, set the corresponding
-        # value to ``None``. This will be used by the template.
-        if page <= 1:
-            newer = None
-        else:
-            newer = page - 1
-
-        if page * entries_per_page >= nr_of_entries:
-            older = None
-        else:
-            older = page + 1
+        entries, older, newer = self.paginate(page, direction, cursor,
+                                              catslug=catslug,
+                                              archivable=False)
 
         return render_template('category.html',
             entries=entries,
@@ -433,30 +852,12 @@ class SiteView(BaseView):
     @permission_name('view_blog')
     @expose('/all/')
     @expose('/all/<int:page>')
-    def all_entries(self, page=1):
+    @expose('/all/<int:page>/<any(older, newer):direction>/<cursor>')
+    def all_entries(self, page=1, direction=None, cursor=None):
+        depends_on('entries', 'comments')
         # Similar to above. Now, we won't filter by category.
-        now = datetime.datetime.utcnow()
-        entries_per_page = g.blog_config.entries_per_page
-        nr_of_entries = query.entries(self.is_preview, archivable=True).count()
-
-        # same as above (see ``self.category``)
-        if nr_of_entries > 0 and (page-1)*entries_per_page >= nr_of_entries:
-            return abort(404)
-
-        entries = query.entries(self.is_preview,
-                start=(page - 1) * entries_per_page,
-                page_size=entries_per_page,
-                archivable=True)
-
-        if page <= 1:
-            newer = None
-        else:
-            newer = page - 1
-
-        if page * entries_per_page >= nr_of_entries:
-            older = None
-        else:
-            older = page + 1
+        entries, older, newer = self.paginate(page, direction, cursor,
+                                              archivable=True)
 
         return render_template('all-entries.html',
             entries=entries,
@@ -495,7 +896,6 @@ def create_comment(db, form, entry):
                       website=form.website.data,
                       content=sanitize_richtext(form.content.data),
                       published=pub_datetime,
-                      number=entry.highest_comment()+1,
                       entry_id=entry.id)
 
     if akis is not None:
@@ -505,6 +905,10 @@ def create_comment(db, form, entry):
         comment.akismet_spam = True
         comment.visible = False
     # Otherwise, apply the defaults, which assume the comment is not spam
+
+    # Taking the number locks the entry until the commit, so we only
+    # do it after talking to Akismet.
+    comment.number = entry.next_comment_number()
     db.session.add(comment)
     db.session.commit()
     return comment, is_spam
@@ -530,6 +934,31 @@ def populate_form(comment_id, form):
     return form
 
 
+# The holes of the cached pages (see ``page_cache``):
+
+@hole_renderer('comment_edit')
+def comment_edit(comment_id, edit_url):
+    """The "Edit" link of a comment, if the reader can still edit it"""
+    editable = reader_editable_comments()
+    if comment_id not in editable:
+        return ''
+    return render_template('comment-edit.html',
+                           comment_id=comment_id,
+                           edit_url=edit_url,
+                           editable=editable[comment_id])
+
+def reader_editable_comments():
+    """The comments the reader can edit, computed once per request"""
+    if not hasattr(g, 'editable_comments'):
+        if session.get('comments'):
+            # Pages served from the cache haven't read the config
+            if not hasattr(g, 'blog_config'):
+                g.blog_config = query.blog_config(query.versions(['config'])['config'])
+            g.editable_comments = editable_comments(g.blog_config.edit_lag(), session)
+        else:
+            g.editable_comments = {}
+    return g.editable_comments
+
 def editable_comments(edit_lag, session):
     """Gets editable comments based on the current time and
     comment publication date"""
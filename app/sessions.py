@@ -0,0 +1,27 @@
+from flask import request
+from flask.sessions import SecureCookieSessionInterface
+
+# Anonymous readers don't get a session cookie until they post a comment,
+# so that the public pages they see can be stored by shared caches (which
+# won't store a response with ``Set-Cookie``).
+#
+# Flask-Login writes the ``'_id'`` of the session protection (a hash of the
+# IP address and user agent) in the session of every visitor. It is
+# recomputed on each request, so a session that holds nothing else isn't
+# worth a cookie.
+
+LOGIN_BOOKKEEPING_KEYS = frozenset(['_id', '_fresh'])
+
+def is_cookieless(app, session):
+    """Whether the current visitor has no session cookie, and won't get one"""
+    # A visitor who already has a cookie keeps getting it updated
+    # (after logging out, the session must lose its ``'user_id'``)
+    return set(session.keys()) <= LOGIN_BOOKKEEPING_KEYS and \
+        app.session_cookie_name not in request.cookies
+
+class LazySessionInterface(SecureCookieSessionInterface):
+    def save_session(self, app, session, response):
+        if is_cookieless(app, session):
+            return
+        return SecureCookieSessionInterface.save_session(self, app, session,
+                                                         response)
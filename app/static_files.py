@@ -0,0 +1,106 @@
+from flask import request, send_file, safe_join, abort
+
+from app import app, assets
+
+import cStringIO
+import gzip
+import mimetypes
+import os
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# The bundles of Flask-Assets (``configure_assets``) and the CKEditor tree
+# (``AssetDirTree``) are written to paths that contain a hash of their
+# contents. A file at such a path never changes, so browsers and proxies
+# may keep it for a year without asking again.
+#
+# They are also precompressed: ``python manager.py compress_static``
+# builds the bundles and writes a ``.gz`` sibling (and a ``.br`` one, if
+# the ``brotli`` module is installed) next to each hashed file. The
+# static route sends the smallest variant the client accepts.
+
+# Encodings of the precompressed siblings, the preferred one first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# Only text compresses well
+COMPRESSIBLE_EXTENSIONS = ['.css', '.js', '.svg', '.html', '.json',
+                           '.xml', '.txt', '.map', '.ttf', '.eot']
+
+def hashed_path_re():
+    patterns = [re.escape(app.config['CKEDITOR_DST']) + r'/[0-9a-f]{16}/']
+    for bundle in assets:
+        if bundle.output and '%(version)s' in bundle.output:
+            parts = [re.escape(part) for part in bundle.output.split('%(version)s')]
+            patterns.append('[0-9a-f]+'.join(parts) + '$')
+    return re.compile('^(?:{})'.format('|'.join(patterns)))
+
+HASHED_PATH_RE = hashed_path_re()
+
+def is_hashed(filename):
+    return HASHED_PATH_RE.match(filename) is not None
+
+def send_static_file(filename):
+    if not is_hashed(filename):
+        return app.send_static_file(filename)
+
+    max_age = app.config['STATIC_IMMUTABLE_MAX_AGE']
+    path = safe_join(app.static_folder, filename)
+    if not os.path.isfile(path):
+        return abort(404)
+    for (encoding, suffix) in ENCODINGS:
+        if request.accept_encodings[encoding] and os.path.isfile(path + suffix):
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response = send_file(path + suffix, mimetype=mimetype,
+                                 conditional=True, cache_timeout=max_age)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_file(path, conditional=True, cache_timeout=max_age)
+    response.vary.add('Accept-Encoding')
+    # Werkzeug doesn't know the ``immutable`` directive
+    response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(max_age)
+    return response
+
+app.view_functions['static'] = send_static_file
+
+def gzip_compress(data):
+    buf = cStringIO.StringIO()
+    # Without a name and a date, the output only depends on the input
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf,
+                       compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+def compress_static():
+    """Builds the bundles and writes the compressed siblings of the hashed
+    static files that don't have them yet. Returns the number of files
+    written."""
+    for bundle in assets:
+        bundle.build()
+    compressors = [('.gz', gzip_compress)]
+    if brotli is not None:
+        compressors.append(('.br', brotli.compress))
+    written = 0
+    for (dirpath, dirnames, filenames) in os.walk(app.static_folder):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            filename = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+            if os.path.splitext(name)[1] not in COMPRESSIBLE_EXTENSIONS or \
+                    not is_hashed(filename):
+                continue
+            for (suffix, compress) in compressors:
+                # Hashed files never change
+                if os.path.exists(path + suffix):
+                    continue
+                with open(path, 'rb') as f:
+                    data = compress(f.read())
+                # Workers never see a half-written file
+                with open(path + suffix + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.rename(path + suffix + '.tmp', path + suffix)
+                written += 1
+    return written
@@ -1,5 +1,6 @@
 import bleach
 from flask import Markup
+import datetime
 
 def format_datetime(attr):
     def inner(c,v,m,n):
@@ -62,3 +63,26 @@ def sanitize_plaintext(text, strip=True):
 # Sanitize rich text using the ``bleach`` library
 def sanitize_richtext(text, strip=False):
     return bleach.clean(text, TAGS_WHITELIST, ATTRIBUTES_WHITELIST)
+
+# Cursors for keyset pagination. A cursor is the ``(created, id)``
+# key of an entry, encoded so that it can be used in a URL.
+CURSOR_DATETIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+def encode_cursor(entry):
+    return '{}-{}'.format(entry.created.strftime(CURSOR_DATETIME_FORMAT), entry.id)
+
+# Raises ``ValueError`` if the cursor is malformed
+def decode_cursor(cursor):
+    created, entry_id = cursor.split('-', 1)
+    return (datetime.datetime.strptime(created, CURSOR_DATETIME_FORMAT),
+            int(entry_id))
+
+# Search results are ordered by rank, so their cursors
+# are ``(rank, id)`` keys (see ``query.search_entries``)
+def encode_search_cursor(result):
+    return '{!r}_{}'.format(result.rank, result.id)
+
+# Raises ``ValueError`` if the cursor is malformed
+def decode_search_cursor(cursor):
+    rank, entry_id = cursor.rsplit('_', 1)
+    return float(rank), int(entry_id)
@@ -193,7 +193,8 @@ class ChooseConfigView(ModelView):
         return redirect(url_for('ChooseConfigView.edit', pk=1))
 
 db.session.remove()
-db.create_all()
+# Only the primary database: the other binds are read replicas
+db.create_all(bind=None)
 
 # Import the client API
 from rest_api import ClientApi
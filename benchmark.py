@@ -0,0 +1,215 @@
+# Measures the latency of the main public routes.
+#
+# The app (``wsgi.application``) is driven in-process through the Werkzeug
+# test client, against the configured database, which should be seeded
+# (see ``fakedata.py``). For each route it reports the 50th, 95th and 99th
+# percentiles of the latency, the number of SQL statements per request and
+# the memory used, and it can save the results as JSON to compare two
+# revisions of the code:
+#
+#     git checkout master && python benchmark.py --output before.json
+#     git checkout my-branch && python benchmark.py --output after.json
+#     python benchmark.py --compare before.json after.json
+#
+# Each route is measured in two modes:
+#
+# - *cold*: the in-process caches (``app.cache``, the page cache, the
+#   blog config) are emptied before each request, and the page cache is
+#   off, so that every request runs the code of the route and its queries;
+# - *warm*: the caches are kept, as in production. After the warmup,
+#   most requests are cache hits.
+#
+# Compare the cold results to measure a change to the code of a route.
+#
+# Python 2 has no ``tracemalloc``: memory is measured as the growth of the
+# peak RSS of the process and of the number of live objects during the
+# requests to a route. The peak RSS only ever grows, so each route and
+# mode is measured in a process of its own, forked from this one.
+import argparse
+import gc
+import json
+import os
+import resource
+import subprocess
+import time
+import traceback
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from wsgi import application
+from app import app, db
+from app.models import Entry, Tag
+from app.pool import dispose_engines
+from app import cache, query
+
+parser = argparse.ArgumentParser(description="Benchmark the public routes of the blog")
+parser.add_argument('--requests', type=int, default=200,
+                    help="requests per route")
+parser.add_argument('--warmup', type=int, default=10,
+                    help="requests per route before measuring")
+parser.add_argument('--search', default='lorem',
+                    help="the search term for the search results page")
+parser.add_argument('--route', action='append', dest='routes',
+                    help="benchmark only this route (can be repeated)")
+parser.add_argument('--mode', action='append', dest='modes',
+                    choices=['cold', 'warm'],
+                    help="benchmark only this mode (can be repeated)")
+parser.add_argument('--output', help="save the results as JSON")
+parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                    help="compare two JSON results instead of running")
+
+statements = [0]
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    statements[0] += 1
+
+def sample_routes(args):
+    """The routes to measure, with arguments taken from the database"""
+    with app.app_context():
+        category = query.home_category()
+        entry = query.entries(False, page_size=1).first()
+        tag = db.session.query(Tag).first()
+        db.session.remove()
+    routes = [('home category', '/category/{}'.format(category.slug)),
+              ('all entries', '/all/'),
+              ('archives', '/archives/'),
+              ('search', '/search-results/entries/{}'.format(args.search)),
+              ('entries feed', '/atom-feed-entries'),
+              ('comments feed', '/atom-feed-comments')]
+    if entry is not None:
+        routes.append(('entry', '/entry/{}/'.format(entry.slug)))
+    if tag is not None:
+        routes.append(('tag', '/tag/{}'.format(tag.slug)))
+    if args.routes:
+        routes = [(name, url) for (name, url) in routes if name in args.routes]
+    return routes
+
+def percentile(sorted_values, p):
+    index = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+MODES = ['cold', 'warm']
+
+def clear_caches():
+    for c in [cache.fragments, cache.feeds, cache.pages, cache.searches]:
+        c.clear()
+    query._blog_config.clear()
+
+def benchmark(client, url, mode, args):
+    cold = mode == 'cold'
+    if cold:
+        app.config['PAGE_CACHE'] = False
+    for _ in range(args.warmup):
+        if cold:
+            clear_caches()
+        client.get(url).close()
+
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    statements[0] = 0
+    latencies = []
+    status_codes = set()
+    for _ in range(args.requests):
+        if cold:
+            clear_caches()
+        start = time.time()
+        response = client.get(url)
+        # Streamed pages are only rendered when the body is read
+        response.get_data()
+        latencies.append((time.time() - start) * 1000)
+        status_codes.add(response.status_code)
+        response.close()
+    gc.collect()
+
+    latencies.sort()
+    return dict(url=url,
+                requests=args.requests,
+                status_codes=sorted(status_codes),
+                p50_ms=percentile(latencies, 50),
+                p95_ms=percentile(latencies, 95),
+                p99_ms=percentile(latencies, 99),
+                queries_per_request=float(statements[0]) / args.requests,
+                max_rss_growth_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+                objects_growth=len(gc.get_objects()) - objects_before)
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def in_child(function, *args):
+    """Runs ``function(*args)`` in a forked process, and returns its result,
+    which must be serializable as JSON"""
+    # The child must open its own connections (see ``app.pool``)
+    dispose_engines(db, app)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        try:
+            with os.fdopen(write_fd, 'w') as f:
+                json.dump(function(*args), f)
+            status = 0
+        except:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        data = f.read()
+    _, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError("The benchmark process failed")
+    return json.loads(data)
+
+def run(args):
+    client = Client(application, BaseResponse)
+    modes = args.modes or MODES
+    results = {}
+    for (name, url) in sample_routes(args):
+        results[name] = {}
+        for mode in modes:
+            results[name][mode] = in_child(benchmark, client, url, mode, args)
+            print_result(name, mode, results[name][mode])
+    return dict(revision=git_revision(), routes=results)
+
+def print_result(name, mode, result):
+    print "{:<16} {:<4}  p50 {:8.2f} ms  p95 {:8.2f} ms  p99 {:8.2f} ms  " \
+          "{:6.1f} queries  +{} kB RSS  +{} objects  {}".format(
+              name, mode, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+              result['queries_per_request'], result['max_rss_growth_kb'],
+              result['objects_growth'], result['status_codes'])
+
+def compare(before_path, after_path):
+    before = json.load(open(before_path))
+    after = json.load(open(after_path))
+    print "{} -> {}".format(before['revision'], after['revision'])
+    for name in sorted(set(before['routes']) & set(after['routes'])):
+        for mode in MODES:
+            old = before['routes'][name].get(mode)
+            new = after['routes'][name].get(mode)
+            if old is None or new is None:
+                continue
+            changes = []
+            for key in ['p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request']:
+                change = (new[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+                changes.append('{} {:.2f} -> {:.2f} ({:+.1f}%)'.format(
+                    key, old[key], new[key], change))
+            print "{:<16} {:<4}  {}".format(name, mode, '  '.join(changes))
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+    else:
+        results = run(args)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
@@ -25,6 +25,9 @@ PAGE_VERSION_PRIVATE = 'private'
 
 CKEDITOR_SRC = 'private/ckeditor'
 CKEDITOR_DST = 'public/ckeditor'
+# Static files whose path contains a hash of their contents are cached
+# for this many seconds, as ``immutable`` (see ``app/static_files.py``)
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
 
 # Test whether we are running on openshift or locally
 try:
@@ -69,6 +72,62 @@ SQLALCHEMY_DATABASE_URI = 'postgresql://{user}:{password}@{host}:{port}/{db}'.fo
             port=POSTGRESQL_PORT,
             db=POSTGRESQL_DBNAME)
 
+# Read replicas of the database, as a list of ``host:port`` strings
+# under ``postgresql_replicas`` in the secrets file. They use the same
+# user, password and database name as the primary. Each replica becomes
+# a Flask-SQLAlchemy bind; read-only public pages and the feeds read from
+# one of them (see ``app/replicas.py``).
+SQLALCHEMY_BINDS = {}
+for i, replica in enumerate(secrets.get('postgresql_replicas') or []):
+    replica_host, replica_port = replica.split(':')
+    SQLALCHEMY_BINDS['replica{}'.format(i)] = \
+        'postgresql://{user}:{password}@{host}:{port}/{db}'.format(
+            user=POSTGRESQL_USERNAME,
+            password=POSTGRESQL_PASSWORD,
+            host=replica_host,
+            port=replica_port,
+            db=POSTGRESQL_DBNAME)
+READ_REPLICAS = sorted(SQLALCHEMY_BINDS)
+
+# After a visitor writes something (a comment, for example), their
+# requests read from the primary for this many seconds, so that
+# they see their own writes even if the replicas lag behind.
+REPLICA_STICKINESS = 30
+
+# Connection pool of each engine (primary and replicas). Every process
+# has its own pools: with a prefork server, the database must accept
+# workers * (SQLALCHEMY_POOL_SIZE + SQLALCHEMY_MAX_OVERFLOW) connections
+# per engine. Use ``/client/api/v1/stats/pool/`` to see how often
+# requests have to wait for a connection.
+SQLALCHEMY_POOL_SIZE = 5
+SQLALCHEMY_MAX_OVERFLOW = 10
+# Seconds to wait for a connection before giving up
+SQLALCHEMY_POOL_TIMEOUT = 10
+# Connections older than this many seconds are replaced
+SQLALCHEMY_POOL_RECYCLE = 1800
+# Test each connection with ``SELECT 1`` before using it
+SQLALCHEMY_POOL_PRE_PING = True
+
+# SQL statements slower than this many seconds are logged to the
+# ``'slow_queries'`` logger (and to SLOW_QUERY_LOG_FILE, if set)
+SLOW_QUERY_THRESHOLD = 0.1
+SLOW_QUERY_LOG_FILE = None
+# Number of slowest statements listed in the ``Server-Timing``
+# header, which is only sent to admins
+SERVER_TIMING_SLOWEST = 3
+
+# Where the profiles of single requests are saved, and the sampling
+# interval of the sampling profiler, in seconds (see ``app/profiler.py``)
+PROFILE_DIR = basedir + '/data/app/profiles'
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# Cache the public pages seen by anonymous readers (see ``app/page_cache.py``).
+# A cached page (or Atom feed) is checked against the database (one query)
+# at most once every PAGE_CACHE_TRUST seconds; in between, it is served
+# without queries, and may lag behind changes made through other processes.
+PAGE_CACHE = True
+PAGE_CACHE_TRUST = 1
+
 # Your App secret key
 SECRET_KEY = secrets['secret_key']
 try:
@@ -80,6 +139,41 @@ except:
 # timedelta (SQL INTERVAL) arithmetic correctly. It can lead to
 # unexpected nasty bugs with date arithmetic.
 
+# Public pages get an ``Expires`` header at most this many seconds in
+# the future, and never later than the next time an entry appears or
+# disappears. 0 means no ``Expires`` header.
+PUBLIC_MAX_AGE = 0
+# Shared caches (a reverse proxy in front of the app) may keep the public
+# pages served to readers without a session cookie for this many seconds
+# (``Cache-Control: s-maxage``), also capped by the next time an entry
+# appears or disappears. 0 means they may not keep them.
+PUBLIC_S_MAXAGE = 60
+
+# The reverse proxy is told which responses to drop when the data behind
+# them changes (see ``app/purge.py``): a ``PURGE_METHOD`` request is sent to
+# ``PURGE_URL`` with the surrogate keys of the changed data in the
+# ``PURGE_KEY_HEADER`` header, at most ``PURGE_BATCH_SIZE`` keys per request.
+# The defaults suit Varnish with the xkey module. None disables purging.
+PURGE_URL = None
+PURGE_METHOD = 'PURGE'
+PURGE_KEY_HEADER = 'xkey-purge'
+PURGE_BATCH_SIZE = 50
+PURGE_TIMEOUT = 2
+# Each purge is sent again after this many seconds, to drop the pages the
+# proxy fetched from a lagging read replica in the meantime. 0 disables it.
+PURGE_REPEAT_AFTER = 5
+
+# Filter public entries on the ``Entry.is_live`` flag instead of comparing
+# their ``since`` and ``until`` dates with the current time. The flag must
+# be kept up to date by running ``python manager.py live_tick``.
+ENTRY_LIVE_FLAG = False
+
+# Number of suggestions shown while typing in the search box, and the
+# minimum number of characters before suggestions are looked up
+# (the trigram indexes need at least 3).
+SEARCH_SUGGESTIONS = 8
+SEARCH_SUGGESTIONS_MIN_LENGTH = 3
+
 # Flask-WTF flag for CSRF
 CSRF_ENABLED = True
 AUTH_TYPE = AUTH_DB
@@ -33,6 +33,15 @@ def set_db_owner():
 def createdb():
     return subprocess.call(['sudo', '-u', 'postgres', 'createdb', POSTGRESQL_DBNAME, '-O', POSTGRESQL_USERNAME])
 
+# Extensions used by the blog (``pg_trgm`` backs the search suggestions).
+# Creating an extension needs a superuser.
+create_extensions_cmd = \
+  'sudo -u postgres psql -d {dbname} -c "CREATE EXTENSION IF NOT EXISTS pg_trgm;"'
+
+def create_extensions():
+    return subprocess.call(create_extensions_cmd.format(dbname=POSTGRESQL_DBNAME),
+                           shell=True)
+
 def dropdb():
     return subprocess.call(['sudo', '-u', 'postgres', 'dropdb', POSTGRESQL_DBNAME])
 
@@ -47,7 +56,10 @@ def dbserver(args):
     if action in ['start', 'stop']:
         service(action)
     elif action == 'createdb':
-        return createdb()
+        createdb()
+        return create_extensions()
+    elif action == 'extensions':
+        return create_extensions()
     elif action == 'dropdb':
         return dropdb()
     elif action == 'createuser':
@@ -64,6 +76,7 @@ def dbserver(args):
         # Try to create a new DB.
         createdb()
         set_db_owner()
+        create_extensions()
 
 
 
@@ -0,0 +1,85 @@
+# Prints the output of ``EXPLAIN ANALYZE`` for the queries in ``app/query.py``.
+#
+# Run it against a seeded database (see ``fakedata.py``), before and after
+# changing a query or an index, and compare the plans and timings:
+#
+#     python explain_queries.py > before.txt
+#     python manager.py db upgrade
+#     python explain_queries.py > after.txt
+import argparse
+import datetime
+
+from app import db
+from app.models import Entry, Comment, VersionStamp
+from app import query
+
+parser = argparse.ArgumentParser(description="EXPLAIN ANALYZE the queries of the blog")
+parser.add_argument('--search', default='lorem',
+                    help="the search term used for the search queries")
+parser.add_argument('--page-size', type=int, default=5)
+
+def explain(q):
+    """Runs ``EXPLAIN ANALYZE`` on a query and returns the plan as text"""
+    statement = q.statement if hasattr(q, 'statement') else q
+    compiled = statement.compile(dialect=db.engine.dialect)
+    # Use the DBAPI cursor directly, so that the parameters compiled
+    # by SQLAlchemy are passed to psycopg2 as they are.
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + unicode(compiled),
+                   compiled.params)
+    return '\n'.join(row[0] for row in cursor.fetchall())
+
+def sample_arguments():
+    """Picks an existing category, entry and time for the queries"""
+    now = datetime.datetime.utcnow()
+    category = query.home_category()
+    entry = db.session.query(Entry).order_by(Entry.comment_count.desc()).first()
+    middle = db.session.query(Entry.created, Entry.id)\
+        .order_by(Entry.created.desc(), Entry.id.desc())\
+        .offset(db.session.query(Entry).count() // 2)\
+        .first()
+    return now, category, entry, middle
+
+def queries(args):
+    now, category, entry, middle = sample_arguments()
+    page = args.page_size
+    comment_ids = [id for (id,) in db.session.query(Comment.id).limit(20)]
+
+    yield 'categories', query.categories()
+    yield 'sidebar_modules', query.sidebar_modules()
+    yield 'versions', db.session.query(VersionStamp)\
+        .filter(VersionStamp.name.in_(['config', 'sidebar']))
+    yield 'next_transition', query.next_transition_query(now)
+    yield 'entry', query.with_profile(db.session.query(Entry), 'detail')\
+        .filter_by(slug=entry.slug, public=True)
+    yield 'comments', query.comments(entry.id)
+    yield 'editable_comments', query.editable_comments(datetime.timedelta(minutes=15),
+                                                       comment_ids)
+    for is_preview in [False, True]:
+        version = 'preview' if is_preview else 'public'
+        yield 'entries ({}, first category page)'.format(version), \
+            query.entries(is_preview, category.slug, page_size=page + 1,
+                          archivable=False, profile='list')
+        yield 'entries ({}, category page after a cursor)'.format(version), \
+            query.entries(is_preview, category.slug, page_size=page + 1,
+                          archivable=False, older_than=middle, profile='list')
+        yield 'entries ({}, all, first page)'.format(version), \
+            query.entries(is_preview, page_size=page + 1, profile='list')
+        yield 'entry_keys ({}, old-style page number)'.format(version), \
+            query.entry_keys(is_preview, start=10 * page, page_size=1)
+        yield 'entries ({}, sidebar)'.format(version), \
+            query.entries(is_preview, page_size=10, profile='archive')
+        yield 'archive_entries ({})'.format(version), \
+            query.archive_entries(is_preview)
+        yield 'search_entries ({})'.format(version), \
+            query.search_entries(is_preview, args.search, page + 1)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    for name, q in queries(args):
+        print "=" * 72
+        print name
+        print "=" * 72
+        print explain(q)
+        print
+    db.session.rollback()
@@ -1,149 +1,301 @@
+# Fills the database with fake data, to try the blog and to measure
+# its performance (see ``benchmark.py`` and ``explain_queries.py``).
+#
+#     python fakedata.py --profile small --seed 42
+#
+# The size of the dataset is chosen with a *profile* (see ``PROFILES``).
+# The same profile and seed always give the same data (with dates
+# relative to the day it runs).
+#
+# Authors, categories, tags and sidebar modules are few, and are added
+# through the ORM in a single transaction. Entries, comments and the tags
+# of the entries are streamed to PostgreSQL with ``COPY``, in chunks,
+# without building them in memory. Entries get their comment counters
+# as they are written, and their search vectors are computed at the end,
+# with a single ``UPDATE`` for each table.
+import argparse
+import bisect
+import cStringIO
+import datetime
+import random
+
 from flask.ext.appbuilder.security.models import User
 
 from app import db
-from app.models import *
-from faker import Factory
-import random
+from app.models import Author, Category, Tag, SidebarModule, \
+    TagCount, ArchiveMonth, VERSION_STAMPS, bump_versions, refresh_live_flags, \
+    clear_summary
+
+# - ``comments``: the number of comments of an entry follows a Pareto
+#   distribution: most entries have a few comments, and a few have
+#   hundreds. ``comment_scale`` is about half the average.
+# - ``tag_skew``: the tags are chosen with a Zipf distribution of this
+#   exponent: the first tags are used much more than the last ones.
+PROFILES = {
+    'tiny': dict(entries=100, authors=2, categories=3, tags=15,
+                 tags_per_entry=5, tag_skew=1.0,
+                 comment_scale=3, comment_alpha=1.5, max_comments=50,
+                 content_words=500, sidebar_modules=4),
+    'small': dict(entries=1000, authors=5, categories=4, tags=50,
+                  tags_per_entry=5, tag_skew=1.1,
+                  comment_scale=3, comment_alpha=1.5, max_comments=200,
+                  content_words=500, sidebar_modules=4),
+    'medium': dict(entries=100000, authors=20, categories=8, tags=500,
+                   tags_per_entry=6, tag_skew=1.2,
+                   comment_scale=3, comment_alpha=1.3, max_comments=2000,
+                   content_words=300, sidebar_modules=6),
+    'large': dict(entries=1000000, authors=50, categories=12, tags=2000,
+                  tags_per_entry=6, tag_skew=1.2,
+                  comment_scale=2, comment_alpha=1.3, max_comments=5000,
+                  content_words=200, sidebar_modules=6),
+}
+
+parser = argparse.ArgumentParser(description="Fill the database with fake data")
+parser.add_argument('--profile', choices=sorted(PROFILES), default='small')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--chunk-size', type=int, default=5000,
+                    help="entries per COPY")
+
+LOREM = """lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod
+tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam quis
+nostrud exercitation ullamco laboris nisi aliquip ex ea commodo consequat duis
+aute irure in reprehenderit voluptate velit esse cillum fugiat nulla pariatur
+excepteur sint occaecat cupidatat non proident sunt culpa qui officia deserunt
+mollit anim id est laborum""".split()
+
+SYLLABLES = ['ba', 'co', 'de', 'fi', 'gu', 'ha', 'ke', 'li', 'mo', 'nu',
+             'pa', 're', 'si', 'to', 'va', 'xe', 'zo', 'an', 'er', 'on']
+
+class Fake(object):
+    """Fast, seeded fake text"""
+
+    def __init__(self, rng):
+        self.rng = rng
+        made_up = set()
+        while len(made_up) < 5000:
+            made_up.add(''.join(rng.choice(SYLLABLES)
+                                for _ in range(rng.randint(2, 4))))
+        # Word frequencies follow Zipf's law, as in real text
+        self.words = LOREM + sorted(made_up)
+        self.cumulative = zipf_cumulative(len(self.words), 1.0)
+
+    def word(self):
+        return self.words[weighted_index(self.rng, self.cumulative)]
+
+    def sentence(self, n):
+        return ' '.join(self.word() for _ in range(n)).capitalize() + '.'
+
+    def text(self, n):
+        sentences = []
+        while n > 0:
+            length = min(n, self.rng.randint(6, 16))
+            sentences.append(self.sentence(length))
+            n -= length
+        return ' '.join(sentences)
+
+    def html(self, n):
+        paragraphs = []
+        while n > 0:
+            length = min(n, self.rng.randint(40, 120))
+            paragraphs.append('<p>' + self.text(length) + '</p>')
+            n -= length
+        return '\n'.join(paragraphs)
+
+def zipf_cumulative(n, skew):
+    """Cumulative weights of ``n`` items with Zipf's law"""
+    total = 0.0
+    cumulative = []
+    for rank in range(1, n + 1):
+        total += 1.0 / (rank ** skew)
+        cumulative.append(total)
+    return cumulative
+
+def weighted_index(rng, cumulative):
+    return bisect.bisect_left(cumulative, rng.random() * cumulative[-1])
+
+def copy_value(value):
+    """A value in the text format of ``COPY``"""
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t')\
+                     .replace('\n', '\\n').replace('\r', '\\r')
+
+class CopyBuffer(object):
+    """Rows waiting to be sent to a table with ``COPY``"""
+
+    def __init__(self, cursor, table, columns):
+        self.cursor = cursor
+        self.statement = 'COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns))
+        self.buffer = cStringIO.StringIO()
+        self.rows = 0
 
+    def add(self, *values):
+        self.buffer.write('\t'.join(copy_value(value) for value in values))
+        self.buffer.write('\n')
+        self.rows += 1
 
-fake = Factory.create()
-
-admin = db.session.query(User).filter(User.role.has(name='Admin')).first()
-
-def tryadd(obj, db):
-    try:
-        db.session.add(obj)
-        db.session.commit()
-        print obj
-        return 1
-    except Exception as e:
-        db.session.rollback()
-        return 0
-
-def fake_entry(author, cat):
-    since = fake.date_time_between(start_date="-15y", end_date="now")
-    until = fake.date_time_between(start_date="now", end_date="+10y")
-    created = since
-    title = fake.sentence()
-
-    return Entry(title=title,
-                 slug=title.strip().replace(',', '')\
-                                   .replace('.', '')\
-                                   .replace(' ', '-')\
-                                   .lower(),
-                 author_id=author.id,
-                 show_author=fake.boolean(80),
-                 category_id=cat.id,
-                 public=fake.boolean(90),
-                 archivable=fake.boolean(90),
-                 lead="<p>"+fake.text(100)+"</p>",
-                 content="<p>"+fake.text(3000)+"</p>",
-                 unlocked=fake.boolean(80),
-                 commentable=fake.boolean(90),
-                 since=since,
-                 until=until,
-                 created=created,
-                 created_by=admin,
-                 changed_by=admin)
-
-def fake_link_list(n, type='ul'):
-    inner = "\n".join(["<li><a>{}</a></li>".format(fake.sentence().title())
-                          for i in xrange(n)])
-    return "<{0}>\n{1}</{0}>".format(type, inner)
-
-def fake_sidebar_module(k, index):
-    return SidebarModule(
-            title=fake.sentence(),
-            text=fake_link_list(k),
-            visible=fake.boolean(70),
-            index=index,
-            created_by=admin,
-            changed_by=admin)
-
-def fake_category(index):
-    word = fake.word()
-    return Category(name=word.capitalize(),
-                    slug=word,
-                    description=fake.sentence(),
-                    index=index)
-
-def fake_tag():
-    name = fake.word()
-    return Tag(name=name,
-               slug=name,
-               description=fake.sentence(),
-               created_by=admin,
-               changed_by=admin)
-
-def fake_sidebar_modules(N, k, db):
-    n = 0
-    while n < N:
-        n = n + tryadd(fake_sidebar_module(k, n), db)
-
-def fake_author():
-    return Author(name=fake.name(),
-                  description=fake.sentence(),
-                  created_by=admin,
-                  changed_by=admin)
-
-def fake_categories(N, db):
-    n = 0
-    while n < N:
-        n = n + tryadd(fake_category(n), db)
-
-def add_independent(creator):
-    def inner(N, db):
-        n = 0
-        while n < N:
-            n = n + tryadd(creator(), db)
-            print n
-    return inner
-
-fake_authors = add_independent(fake_author)
-fake_tags = add_independent(fake_tag)
-
-def fake_entries(N, db):
-    for author in db.session.query(Author).all():
-        for cat in db.session.query(Category).filter_by(name='Main').all():
-            n = 0
-            while n < N:
-                entry = fake_entry(author, cat)
-                n = n + tryadd(entry, db)
-
-def fake_comments(N, db):
-    for entry in db.session.query(Entry).all():
-        n = 0
-        last_date = entry.created
-        while n < N:
-            comm = fake_comment(entry, last_date)
-            n = n + tryadd(comm, db)
-            last_date = comm.published
-
-
-
-def fake_comment(entry, last_date):
-    profile = fake.profile()
-    return Comment(name=profile['name'],
-                   email=profile['mail'],
-                   website=fake.url(),
-                   content=fake.text(300),
-                   published=fake.date_time_between(last_date, 'now'),
-                   number=entry.highest_comment()+1,
-                   entry_id=entry.id)
-
-def add_tags(N, db):
-    tags = db.session.query(Tag).all()
-    for entry in db.session.query(Entry).all():
-        entry.tags = random.sample(tags, N)
+    def flush(self):
+        self.buffer.seek(0)
+        self.cursor.copy_expert(self.statement, self.buffer)
+        self.buffer = cStringIO.StringIO()
+
+def add_small_tables(fake, profile, admin):
+    rng = fake.rng
+    audit = dict(created_by=admin, changed_by=admin)
+    # Unique names and slugs, even when adding to existing data
+    first_category = next_id('category')
+    first_tag = next_id('tag')
+    authors = [Author(name=fake.sentence(2)[:-1], description=fake.sentence(8),
+                      **audit)
+               for i in range(profile['authors'])]
+    categories = [Category(name='{} {}'.format(fake.word().capitalize(), first_category + i),
+                           slug='{}-{}'.format(fake.word(), first_category + i),
+                           description=fake.sentence(8),
+                           show=True,
+                           index=i)
+                  for i in range(profile['categories'])]
+    tags = []
+    for i in range(profile['tags']):
+        name = '{}-{}'.format(fake.word(), first_tag + i)
+        tags.append(Tag(name=name, slug=name, description=fake.sentence(8),
+                        **audit))
+    modules = [SidebarModule(title=fake.sentence(3),
+                             text='<ul>\n' + '\n'.join('<li><a>{}</a></li>'.format(fake.sentence(4))
+                                                     for _ in range(10)) + '\n</ul>',
+                             visible=rng.random() < 0.7,
+                             index=i,
+                             **audit)
+               for i in range(profile['sidebar_modules'])]
+    db.session.add_all(authors + categories + tags + modules)
     db.session.commit()
+    return ([author.id for author in authors],
+            [category.id for category in categories],
+            [tag.id for tag in tags])
+
+def next_id(table):
+    return db.session.execute('SELECT coalesce(max(id), 0) + 1 FROM {}'.format(table))\
+        .scalar()
+
+ENTRY_COLUMNS = ['id', 'author_id', 'show_author', 'title', 'slug', 'public',
+                 'lead', 'content', 'commentable', 'unlocked', 'since',
+                 'show_date', 'until', 'created', 'archivable', 'category_id',
+                 'comment_count', 'comment_seq', 'created_on', 'changed_on',
+                 'created_by_fk', 'changed_by_fk']
+
+COMMENT_COLUMNS = ['id', 'name', 'email', 'website', 'content', 'published',
+                   'visible', 'akismet_spam', 'confirmed_spam', 'number',
+                   'entry_id']
+
+def add_entries(fake, profile, author_ids, category_ids, tag_ids, admin, chunk_size):
+    rng = fake.rng
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    span = 15 * 365 * 24 * 3600
+    tag_cumulative = zipf_cumulative(len(tag_ids), profile['tag_skew'])
+
+    cursor = db.session.connection().connection.cursor()
+    entries = CopyBuffer(cursor, 'entry', ENTRY_COLUMNS)
+    comments = CopyBuffer(cursor, 'comment', COMMENT_COLUMNS)
+    entry_tags = CopyBuffer(cursor, 'entry_tag', ['entry_id', 'tag_id'])
+
+    entry_id = next_id('entry')
+    comment_id = next_id('comment')
+    for n in xrange(profile['entries']):
+        created = now - datetime.timedelta(seconds=rng.randint(0, span))
+        # Most entries are always visible, some have a window
+        since = created if rng.random() < 0.2 else None
+        until = None
+        if rng.random() < 0.05:
+            until = created + datetime.timedelta(days=rng.randint(1, 3650))
+        title = fake.sentence(rng.randint(3, 9))[:-1]
+        slug = '{}-{}'.format('-'.join(title.lower().split()[:6]), entry_id)
+
+        n_comments = min(profile['max_comments'],
+                         int(profile['comment_scale'] *
+                             (rng.paretovariate(profile['comment_alpha']) - 1)))
+        visible_comments = 0
+        published = created
+        for number in xrange(1, n_comments + 1):
+            # Up to a week after the previous comment, but never in the future
+            left = int((now - published).total_seconds())
+            published = published + datetime.timedelta(
+                seconds=rng.randint(min(60, left), min(7 * 24 * 3600, left)))
+            visible = rng.random() < 0.95
+            visible_comments += visible
+            name = fake.sentence(2)[:-1]
+            comments.add(comment_id, name,
+                         '{}@example.com'.format(name.replace(' ', '.').lower()),
+                         'http://example.com/{}'.format(fake.word()),
+                         fake.text(rng.randint(10, 80)),
+                         published, visible, not visible, not visible,
+                         number, entry_id)
+            comment_id += 1
+
+        entries.add(entry_id, rng.choice(author_ids), rng.random() < 0.8,
+                    title, slug, rng.random() < 0.9,
+                    '<p>' + fake.text(40) + '</p>',
+                    fake.html(profile['content_words']),
+                    rng.random() < 0.9, rng.random() < 0.8,
+                    since, True, until, created, rng.random() < 0.9,
+                    rng.choice(category_ids), visible_comments, n_comments,
+                    created, created, admin.id, admin.id)
 
-def fake_data(db):
-    # fake_categories(3, db)
-    fake_tags(15, db)
-    fake_authors(2, db)
-    fake_entries(10, db)
-    fake_comments(10, db)
-    fake_sidebar_modules(4, 10, db)
-    add_tags(5, db)
+        chosen = set()
+        for _ in range(rng.randint(0, profile['tags_per_entry'])):
+            chosen.add(tag_ids[weighted_index(rng, tag_cumulative)])
+        for tag_id in sorted(chosen):
+            entry_tags.add(entry_id, tag_id)
+
+        entry_id += 1
+        if (n + 1) % chunk_size == 0:
+            # Entries first: the comments and tags refer to them
+            for buf in [entries, comments, entry_tags]:
+                buf.flush()
+            print "{} entries, {} comments".format(entries.rows, comments.rows)
+
+    for buf in [entries, comments, entry_tags]:
+        buf.flush()
+    print "{} entries, {} comments".format(entries.rows, comments.rows)
+
+    # ``COPY`` bypasses the sequences of the ``id`` columns
+    for table in ['entry', 'comment']:
+        db.session.execute(
+            "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+            "(SELECT max(id) FROM {0}))".format(table))
+
+def generate(profile, seed, chunk_size):
+    rng = random.Random(seed)
+    fake = Fake(rng)
+    admin = db.session.query(User).filter(User.role.has(name='Admin')).first()
+
+    author_ids, category_ids, tag_ids = add_small_tables(fake, profile, admin)
+
+    # The search vectors are maintained by triggers (``make_searchable``).
+    # Firing them for every row would make the load much slower, so they
+    # are disabled during the load and the vectors are computed afterwards.
+    # ``USER`` leaves the triggers of the foreign keys alone.
+    for table in ['entry', 'comment']:
+        db.session.execute('ALTER TABLE {} DISABLE TRIGGER USER'.format(table))
+    add_entries(fake, profile, author_ids, category_ids, tag_ids, admin, chunk_size)
+    for table in ['entry', 'comment']:
+        db.session.execute('ALTER TABLE {} ENABLE TRIGGER USER'.format(table))
+        print "Computing the search vectors of {}".format(table)
+        # The entry trigger only fires when the indexed columns are set
+        # (see ``models.ENTRY_SEARCH_TRIGGER``)
+        db.session.execute('UPDATE {} SET content = content WHERE search_vector IS NULL'.format(table))
+
+    refresh_live_flags(db.session, datetime.datetime.utcnow())
+    # Recomputed on demand
+    clear_summary(db.session, TagCount)
+    clear_summary(db.session, ArchiveMonth)
+    bump_versions(db.session, VERSION_STAMPS)
+    db.session.commit()
 
-fake_data(db)
+if __name__ == "__main__":
+    args = parser.parse_args()
+    generate(PROFILES[args.profile], args.seed, args.chunk_size)
@@ -0,0 +1,37 @@
+"""Add indexes for the queries in app/query.py
+
+Revision ID: 1c7e4b9f0a36
+Revises: 5a81d3e6c2f9
+Create Date: 2026-10-18 12:20:09.664213
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1c7e4b9f0a36'
+down_revision = '5a81d3e6c2f9'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_entry_category_id_created_id', 'entry',
+                    ['category_id', 'created', 'id'])
+    op.create_index('ix_entry_created_id', 'entry', ['created', 'id'])
+    op.create_index('ix_entry_public_archivable_created_id', 'entry',
+                    ['created', 'id'],
+                    postgresql_where=sa.text('public = true AND archivable = true'))
+    op.create_index('ix_comment_entry_id_published', 'comment',
+                    ['entry_id', 'published'])
+    op.create_index('ix_entry_tag_tag_id_entry_id', 'entry_tag',
+                    ['tag_id', 'entry_id'])
+    op.create_index('ix_entry_tag_entry_id', 'entry_tag', ['entry_id'])
+
+
+def downgrade():
+    op.drop_index('ix_entry_tag_entry_id', 'entry_tag')
+    op.drop_index('ix_entry_tag_tag_id_entry_id', 'entry_tag')
+    op.drop_index('ix_comment_entry_id_published', 'comment')
+    op.drop_index('ix_entry_public_archivable_created_id', 'entry')
+    op.drop_index('ix_entry_created_id', 'entry')
+    op.drop_index('ix_entry_category_id_created_id', 'entry')
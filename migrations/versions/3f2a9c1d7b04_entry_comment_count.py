@@ -0,0 +1,27 @@
+"""Add Entry.comment_count
+
+Revision ID: 3f2a9c1d7b04
+Revises: None
+Create Date: 2026-10-18 10:12:31.408122
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7b04'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('entry', sa.Column('comment_count', sa.Integer(),
+                                     nullable=False, server_default='0'))
+    # Same as ``python manager.py backfill_comment_counts``
+    op.execute("""UPDATE entry SET comment_count =
+                    (SELECT count(*) FROM comment
+                     WHERE comment.entry_id = entry.id AND comment.visible)""")
+
+
+def downgrade():
+    op.drop_column('entry', 'comment_count')
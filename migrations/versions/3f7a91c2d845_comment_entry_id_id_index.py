@@ -0,0 +1,22 @@
+"""Add an index for the last comment of an entry
+
+Revision ID: 3f7a91c2d845
+Revises: e6c1f08a9d52
+Create Date: 2026-10-18 17:02:41.518306
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f7a91c2d845'
+down_revision = 'e6c1f08a9d52'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_comment_entry_id_id', 'comment', ['entry_id', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_comment_entry_id_id', 'comment')
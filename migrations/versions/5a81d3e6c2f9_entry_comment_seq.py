@@ -0,0 +1,47 @@
+"""Add Entry.comment_seq and make comment numbers unique per entry
+
+Revision ID: 5a81d3e6c2f9
+Revises: 3f2a9c1d7b04
+Create Date: 2026-10-18 11:02:47.915630
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a81d3e6c2f9'
+down_revision = '3f2a9c1d7b04'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Comments posted at the same time may have gotten the same number.
+    # Give the duplicates new numbers after the highest one of the entry.
+    op.execute("""UPDATE comment SET number = duplicate.new_number
+                  FROM (SELECT numbered.id,
+                               highest.number + row_number() OVER
+                                 (PARTITION BY numbered.entry_id
+                                  ORDER BY numbered.id) AS new_number
+                        FROM (SELECT id, entry_id,
+                                     row_number() OVER
+                                       (PARTITION BY entry_id, number
+                                        ORDER BY id) AS position
+                              FROM comment) AS numbered
+                        JOIN (SELECT entry_id, max(number) AS number
+                              FROM comment GROUP BY entry_id) AS highest
+                          ON highest.entry_id = numbered.entry_id
+                        WHERE numbered.position > 1) AS duplicate
+                  WHERE comment.id = duplicate.id""")
+    op.create_unique_constraint('uq_comment_entry_id_number', 'comment',
+                                ['entry_id', 'number'])
+
+    op.add_column('entry', sa.Column('comment_seq', sa.Integer(),
+                                     nullable=False, server_default='0'))
+    op.execute("""UPDATE entry SET comment_seq =
+                    (SELECT coalesce(max(number), 0) FROM comment
+                     WHERE comment.entry_id = entry.id)""")
+
+
+def downgrade():
+    op.drop_column('entry', 'comment_seq')
+    op.drop_constraint('uq_comment_entry_id_number', 'comment', type_='unique')
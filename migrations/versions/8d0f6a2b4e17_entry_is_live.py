@@ -0,0 +1,38 @@
+"""Add Entry.is_live and indexes for the visibility transitions
+
+Revision ID: 8d0f6a2b4e17
+Revises: 1c7e4b9f0a36
+Create Date: 2026-10-18 13:05:52.120457
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d0f6a2b4e17'
+down_revision = '1c7e4b9f0a36'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_entry_since', 'entry', ['since'],
+                    postgresql_where=sa.text('since IS NOT NULL'))
+    op.create_index('ix_entry_until', 'entry', ['until'],
+                    postgresql_where=sa.text('until IS NOT NULL'))
+
+    op.add_column('entry', sa.Column('is_live', sa.Boolean(),
+                                     nullable=False, server_default='false'))
+    op.execute("""UPDATE entry SET is_live =
+                    (coalesce(public, false)
+                     AND (since IS NULL OR since <= now() AT TIME ZONE 'utc')
+                     AND (until IS NULL OR until >= now() AT TIME ZONE 'utc'))""")
+    op.create_index('ix_entry_live_archivable_created_id', 'entry',
+                    ['created', 'id'],
+                    postgresql_where=sa.text('is_live = true AND archivable = true'))
+
+
+def downgrade():
+    op.drop_index('ix_entry_live_archivable_created_id', 'entry')
+    op.drop_column('entry', 'is_live')
+    op.drop_index('ix_entry_until', 'entry')
+    op.drop_index('ix_entry_since', 'entry')
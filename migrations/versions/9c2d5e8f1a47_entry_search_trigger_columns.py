@@ -0,0 +1,28 @@
+"""Recompute the search vector of an entry only when its text changes
+
+Revision ID: 9c2d5e8f1a47
+Revises: 3f7a91c2d845
+Create Date: 2026-10-18 18:21:09.734152
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9c2d5e8f1a47'
+down_revision = '3f7a91c2d845'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute("DROP TRIGGER IF EXISTS entry_search_vector_trigger ON entry")
+    op.execute("""CREATE TRIGGER entry_search_vector_trigger
+                    BEFORE INSERT OR UPDATE OF title, lead, content ON entry
+                    FOR EACH ROW EXECUTE PROCEDURE entry_search_vector_update()""")
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS entry_search_vector_trigger ON entry")
+    op.execute("""CREATE TRIGGER entry_search_vector_trigger
+                    BEFORE UPDATE OR INSERT ON entry
+                    FOR EACH ROW EXECUTE PROCEDURE entry_search_vector_update()""")
@@ -0,0 +1,23 @@
+"""Add an index for the comments feed
+
+Revision ID: b4e29c75d310
+Revises: 8d0f6a2b4e17
+Create Date: 2026-10-18 13:48:16.307781
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b4e29c75d310'
+down_revision = '8d0f6a2b4e17'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_comment_visible_published', 'comment',
+                    ['visible', sa.text('published DESC')])
+
+
+def downgrade():
+    op.drop_index('ix_comment_visible_published', 'comment')
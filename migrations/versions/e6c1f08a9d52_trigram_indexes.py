@@ -0,0 +1,29 @@
+"""Add trigram indexes for the search suggestions
+
+Revision ID: e6c1f08a9d52
+Revises: b4e29c75d310
+Create Date: 2026-10-18 14:02:37.514209
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e6c1f08a9d52'
+down_revision = 'b4e29c75d310'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_entry_title_trgm', 'entry', ['title'],
+                    postgresql_using='gin',
+                    postgresql_ops={'title': 'gin_trgm_ops'})
+    op.create_index('ix_tag_name_trgm', 'tag', ['name'],
+                    postgresql_using='gin',
+                    postgresql_ops={'name': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_tag_name_trgm', 'tag')
+    op.drop_index('ix_entry_title_trgm', 'entry')
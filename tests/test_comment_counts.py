@@ -0,0 +1,79 @@
+# Runs against the configured database, in a transaction that is rolled
+# back at the end:
+#
+#     python -m unittest discover tests
+import datetime
+import unittest
+
+from app import app, db
+from app.models import Entry, Comment
+
+
+class CommentCountTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        now = datetime.datetime.utcnow()
+        self.entries = [Entry(title='Commented', slug='comment-count-{}'.format(i),
+                              lead='', content='', public=True, archivable=True,
+                              created=now)
+                        for i in range(2)]
+        db.session.add_all(self.entries)
+        db.session.flush()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        self.context.pop()
+
+    def comment(self, entry, visible=True):
+        comment = Comment(name='Reader', content='Hello',
+                          published=datetime.datetime.utcnow(),
+                          entry_id=entry.id, visible=visible,
+                          number=entry.next_comment_number())
+        db.session.add(comment)
+        db.session.flush()
+        return comment
+
+    def counts(self):
+        for entry in self.entries:
+            db.session.refresh(entry)
+        return [entry.comment_count for entry in self.entries]
+
+    def test_only_visible_comments_are_counted(self):
+        first = self.entries[0]
+        self.comment(first)
+        self.comment(first)
+        self.comment(first, visible=False)
+        self.assertEqual(self.counts(), [2, 0])
+
+    def test_moderation_changes_the_count(self):
+        first = self.entries[0]
+        comment = self.comment(first)
+        self.comment(first)
+        comment.visible = False
+        db.session.flush()
+        self.assertEqual(self.counts(), [1, 0])
+        comment.visible = True
+        db.session.flush()
+        self.assertEqual(self.counts(), [2, 0])
+
+    def test_a_moved_comment_is_counted_in_its_new_entry(self):
+        first, other = self.entries
+        comment = self.comment(first)
+        comment.entry_id = other.id
+        db.session.flush()
+        self.assertEqual(self.counts(), [0, 1])
+
+    def test_a_deleted_comment_is_not_counted(self):
+        first = self.entries[0]
+        comment = self.comment(first)
+        self.comment(first)
+        db.session.delete(comment)
+        db.session.flush()
+        self.assertEqual(self.counts(), [1, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
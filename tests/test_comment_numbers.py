@@ -0,0 +1,90 @@
+# Runs against the configured database. The concurrent comments must be
+# committed, so the entry and its comments are deleted at the end:
+#
+#     python -m unittest discover tests
+import datetime
+import threading
+import time
+import unittest
+
+from app import app, db
+from app.models import Entry, Comment, VersionStamp
+
+
+class CommentNumberTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        self.entry = Entry(title='Numbered', slug='comment-number-test',
+                           lead='', content='', public=True, archivable=True,
+                           created=datetime.datetime.utcnow())
+        db.session.add(self.entry)
+        db.session.commit()
+        self.entry_id = self.entry.id
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.query(Comment)\
+            .filter_by(entry_id=self.entry_id)\
+            .delete(synchronize_session=False)
+        db.session.delete(db.session.query(Entry).get(self.entry_id))
+        db.session.flush()
+        db.session.query(VersionStamp)\
+            .filter_by(name='entry:{}'.format(self.entry_id))\
+            .delete(synchronize_session=False)
+        db.session.commit()
+        db.session.remove()
+        self.context.pop()
+
+    def post(self, entry, content):
+        comment = Comment(name='Reader', content=content,
+                          published=datetime.datetime.utcnow(),
+                          entry_id=entry.id,
+                          number=entry.next_comment_number())
+        db.session.add(comment)
+        return comment
+
+    def test_numbers_follow_each_other(self):
+        comments = [self.post(self.entry, 'Comment {}'.format(i)) for i in range(3)]
+        db.session.flush()
+        self.assertEqual([comment.number for comment in comments], [1, 2, 3])
+
+    def test_concurrent_comments_get_different_numbers(self):
+        numbered = threading.Event()
+        errors = []
+
+        def post(first):
+            with app.app_context():
+                try:
+                    if not first:
+                        numbered.wait(5)
+                    entry = db.session.query(Entry).get(self.entry_id)
+                    self.post(entry, 'Concurrent')
+                    if first:
+                        # The other one takes its number now, and must
+                        # wait for this transaction
+                        numbered.set()
+                        time.sleep(0.3)
+                    db.session.commit()
+                except Exception as e:
+                    errors.append(e)
+                    numbered.set()
+
+        threads = [threading.Thread(target=post, args=(first,))
+                   for first in [True, False]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        numbers = [number for (number,) in
+                   db.session.query(Comment.number)
+                     .filter_by(entry_id=self.entry_id)
+                     .order_by(Comment.number)]
+        self.assertEqual(numbers, [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# Runs against the configured database, in a transaction that is rolled
+# back at the end:
+#
+#     python -m unittest discover tests
+import datetime
+import unittest
+
+from app import app, db
+from app import query
+from app.models import Entry, Category
+from app.utils import encode_cursor, decode_cursor
+
+
+class KeysetPaginationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        category = Category(name='Keyset test', slug='keyset-test',
+                            show=False, index=100)
+        created = datetime.datetime(2015, 3, 1, 12, 0, 0, 250000)
+        # Several entries share the same date: only the id breaks the ties
+        self.entries = [Entry(title='Entry {}'.format(i),
+                              slug='keyset-test-{}'.format(i),
+                              lead='', content='', public=True, archivable=True,
+                              category=category,
+                              created=created + datetime.timedelta(hours=i // 3))
+                        for i in range(8)]
+        db.session.add_all(self.entries)
+        db.session.flush()
+        # Newest first
+        self.expected = [entry.id for entry in
+                         sorted(self.entries, key=lambda entry: (entry.created, entry.id),
+                                reverse=True)]
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        self.context.pop()
+
+    def page(self, **kwargs):
+        return query.entries_page(True, 3, catslug='keyset-test', **kwargs)
+
+    def cursor(self, entry):
+        return decode_cursor(encode_cursor(entry))
+
+    def test_older_pages_go_through_every_entry_once(self):
+        seen = []
+        rows, has_more = self.page()
+        seen.extend(entry.id for entry in rows)
+        while has_more:
+            rows, has_more = self.page(older_than=self.cursor(rows[-1]))
+            seen.extend(entry.id for entry in rows)
+        self.assertEqual(seen, self.expected)
+
+    def test_newer_pages_are_the_older_pages_backwards(self):
+        # The first entry of the last page (pages of 3, 3 and 2 entries)
+        first = db.session.query(Entry).get(self.expected[6])
+        rows, has_more = self.page(newer_than=self.cursor(first))
+        self.assertEqual([entry.id for entry in rows], self.expected[3:6])
+        self.assertTrue(has_more)
+        rows, has_more = self.page(newer_than=self.cursor(rows[0]))
+        self.assertEqual([entry.id for entry in rows], self.expected[0:3])
+        self.assertFalse(has_more)
+
+    def test_page_numbers_are_translated_into_keys(self):
+        for position in range(len(self.expected)):
+            key = query.entry_key_at(True, position, catslug='keyset-test')
+            self.assertEqual(key.id, self.expected[position])
+        self.assertIsNone(query.entry_key_at(True, len(self.expected),
+                                             catslug='keyset-test'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# Runs against the configured database. The pages are requested through
+# the test client, which doesn't see uncommitted data, so the entry is
+# committed, and deleted at the end:
+#
+#     python -m unittest discover tests
+import datetime
+import unittest
+
+from app import app, db
+from app.cache import pages
+from app.models import Entry, Category, Comment, VersionStamp
+
+
+class PageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = dict((name, app.config[name]) for name in
+                           ['PAGE_CACHE', 'PAGE_CACHE_TRUST', 'READ_REPLICAS',
+                            'PUBLIC_S_MAXAGE'])
+        app.config.update(PAGE_CACHE=True,
+                          PAGE_CACHE_TRUST=0,
+                          READ_REPLICAS=[],
+                          PUBLIC_S_MAXAGE=60)
+        pages.clear()
+        with app.app_context():
+            category = Category(name='Page cache test', slug='page-cache-test',
+                                show=False, index=100)
+            entry = Entry(title='Xylograph', slug='page-cache-test',
+                          lead='', content='<p>Cached</p>',
+                          public=True, archivable=True, commentable=True,
+                          category=category, created=datetime.datetime.utcnow())
+            db.session.add(entry)
+            db.session.flush()
+            comment = Comment(name='Reader', content='First',
+                              published=datetime.datetime.utcnow(),
+                              entry_id=entry.id,
+                              number=entry.next_comment_number())
+            db.session.add(comment)
+            db.session.commit()
+            self.category_id = category.id
+            self.entry_id = entry.id
+            self.comment_id = comment.id
+        self.url = '/entry/page-cache-test/'
+        self.client = app.test_client()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.query(Comment)\
+                .filter_by(entry_id=self.entry_id)\
+                .delete(synchronize_session=False)
+            db.session.delete(db.session.query(Entry).get(self.entry_id))
+            db.session.delete(db.session.query(Category).get(self.category_id))
+            db.session.flush()
+            db.session.query(VersionStamp)\
+                .filter(VersionStamp.name.in_(['entry:{}'.format(self.entry_id),
+                                               'category:{}'.format(self.category_id)]))\
+                .delete(synchronize_session=False)
+            db.session.commit()
+        pages.clear()
+        app.config.update(self.config)
+
+    def get(self, client=None):
+        response = (client or self.client).get(self.url)
+        return response.headers.get('X-Page-Cache'), response.get_data()
+
+    def change_title(self, title):
+        with app.app_context():
+            db.session.query(Entry).get(self.entry_id).title = title
+            db.session.commit()
+
+    def test_pages_are_served_from_the_cache(self):
+        status, body = self.get()
+        self.assertEqual(status, 'miss')
+        self.assertEqual(self.get(), ('hit', body))
+
+    def test_a_changed_entry_is_rendered_again(self):
+        self.get()
+        self.assertEqual(self.get()[0], 'hit')
+        self.change_title('Quillwort')
+        status, body = self.get()
+        self.assertEqual(status, 'miss')
+        self.assertIn('Quillwort', body)
+        self.assertNotIn('Xylograph', body)
+
+    def test_trusted_pages_are_not_kept_by_the_proxy(self):
+        app.config['PAGE_CACHE_TRUST'] = 60
+        self.get()
+        self.change_title('Quillwort')
+        # Within the trust window, the page isn't checked
+        response = self.client.get(self.url)
+        self.assertEqual(response.headers.get('X-Page-Cache'), 'hit')
+        self.assertIn('Xylograph', response.get_data())
+        self.assertEqual(response.cache_control.s_maxage, 0)
+
+    def test_holes_are_filled_for_each_reader(self):
+        edit_link = 'comment-edit-{}'.format(self.comment_id)
+        status, body = self.get()
+        self.assertEqual(status, 'miss')
+        self.assertNotIn(edit_link, body)
+
+        # The reader who wrote the comment gets the cached page,
+        # with the "Edit" link of the comment
+        author = app.test_client()
+        with author.session_transaction() as session:
+            session['comments'] = [self.comment_id]
+        status, body = self.get(author)
+        self.assertEqual(status, 'hit')
+        self.assertIn(edit_link, body)
+
+        status, body = self.get()
+        self.assertEqual(status, 'hit')
+        self.assertNotIn(edit_link, body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+# Runs against the configured database. The changes are committed, so
+# that they are purged, and deleted at the end:
+#
+#     python -m unittest discover tests
+import BaseHTTPServer
+import datetime
+import threading
+import time
+import unittest
+
+from app import app, db
+from app.models import Entry, Category, Comment, VersionStamp
+
+PURGE_KEY_HEADER = 'xkey-purge'
+
+
+class StubProxy(BaseHTTPServer.HTTPServer):
+    """Records the purge requests it receives"""
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), PurgeHandler)
+        self.purges = []
+        self.lock = threading.Lock()
+
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+    def received(self):
+        with self.lock:
+            return list(self.purges)
+
+class PurgeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_PURGE(self):
+        keys = self.headers.get(PURGE_KEY_HEADER, '').split()
+        with self.server.lock:
+            self.server.purges.append((self.command, keys))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PurgeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        self.category = Category(name='Purge test', slug='purge-test',
+                                 show=False, index=100)
+        db.session.add(self.category)
+        db.session.commit()
+
+        self.proxy = StubProxy()
+        self.server = threading.Thread(target=self.proxy.serve_forever)
+        self.server.daemon = True
+        self.server.start()
+        self.config = dict((name, app.config[name]) for name in
+                           ['PURGE_URL', 'PURGE_METHOD', 'PURGE_KEY_HEADER',
+                            'PURGE_BATCH_SIZE', 'PURGE_REPEAT_AFTER'])
+        app.config.update(PURGE_URL=self.proxy.url(),
+                          PURGE_METHOD='PURGE',
+                          PURGE_KEY_HEADER=PURGE_KEY_HEADER,
+                          PURGE_BATCH_SIZE=2,
+                          PURGE_REPEAT_AFTER=0)
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['PURGE_URL'] = None
+        stamps = ['category:{}'.format(self.category.id)]
+        for entry in db.session.query(Entry).filter_by(category_id=self.category.id):
+            stamps.append('entry:{}'.format(entry.id))
+            for comment in entry.comments:
+                db.session.delete(comment)
+            db.session.delete(entry)
+        db.session.delete(self.category)
+        db.session.flush()
+        db.session.query(VersionStamp)\
+            .filter(VersionStamp.name.in_(stamps))\
+            .delete(synchronize_session=False)
+        db.session.commit()
+        db.session.remove()
+        self.context.pop()
+        app.config.update(self.config)
+        self.proxy.shutdown()
+        self.proxy.server_close()
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            purges = self.proxy.received()
+            if condition(purges):
+                return purges
+            time.sleep(0.05)
+        return self.proxy.received()
+
+    def purged_keys(self, purges):
+        return set(key for (method, keys) in purges for key in keys)
+
+    def new_entry(self):
+        entry = Entry(title='Purged', slug='purge-test-entry', lead='',
+                      content='', public=True, archivable=True,
+                      category_id=self.category.id,
+                      created=datetime.datetime.utcnow())
+        db.session.add(entry)
+        db.session.commit()
+        return entry
+
+    def test_a_commit_purges_the_stamps_it_bumped_in_batches(self):
+        entry = self.new_entry()
+        expected = set(['sidebar', 'entries', 'comments',
+                        'entry:{}'.format(entry.id),
+                        'category:{}'.format(self.category.id)])
+        purges = self.wait_for(lambda purges: self.purged_keys(purges) >= expected)
+        self.assertEqual(self.purged_keys(purges), expected)
+        # 5 keys, at most 2 per request
+        self.assertEqual(len(purges), 3)
+        for (method, keys) in purges:
+            self.assertEqual(method, 'PURGE')
+            self.assertTrue(1 <= len(keys) <= 2)
+
+    def test_a_new_comment_purges_its_entry(self):
+        entry = self.new_entry()
+        self.wait_for(lambda purges: len(self.purged_keys(purges)) == 5)
+        with self.proxy.lock:
+            del self.proxy.purges[:]
+
+        db.session.add(Comment(name='Reader', content='Hello',
+                               published=datetime.datetime.utcnow(),
+                               entry_id=entry.id,
+                               number=entry.next_comment_number()))
+        db.session.commit()
+        expected = set(['comments', 'entry:{}'.format(entry.id)])
+        purges = self.wait_for(lambda purges: self.purged_keys(purges) >= expected)
+        self.assertEqual(self.purged_keys(purges), expected)
+
+    def test_a_rolled_back_transaction_purges_nothing(self):
+        db.session.add(Entry(title='Never', slug='purge-test-rolled-back',
+                             lead='', content='', public=True,
+                             category_id=self.category.id,
+                             created=datetime.datetime.utcnow()))
+        db.session.flush()
+        db.session.rollback()
+        # Anything committed afterwards doesn't purge the forgotten stamps
+        self.category.description = 'Changed'
+        db.session.commit()
+        expected = set(['sidebar', 'category:{}'.format(self.category.id)])
+        purges = self.wait_for(lambda purges: self.purged_keys(purges) >= expected)
+        self.assertEqual(self.purged_keys(purges), expected)
+
+    def test_purges_are_repeated(self):
+        app.config['PURGE_REPEAT_AFTER'] = 0.2
+        self.category.description = 'Changed'
+        db.session.commit()
+        key = 'category:{}'.format(self.category.id)
+        count = lambda purges: sum(keys.count(key) for (method, keys) in purges)
+        purges = self.wait_for(lambda purges: count(purges) >= 2)
+        self.assertEqual(count(purges), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+# Runs against the configured database, in a transaction that is rolled
+# back at the end:
+#
+#     python -m unittest discover tests
+import datetime
+import unittest
+
+from app import app, db
+from app import query
+from app.models import Entry
+from app.utils import encode_search_cursor, decode_search_cursor
+
+
+class SearchPaginationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        now = datetime.datetime.utcnow()
+        # Identical entries have identical ranks
+        self.entries = [Entry(title='Tied', slug='tied-rank-{}'.format(i),
+                              lead='', content='zyzzyva ' * (i % 2 + 1),
+                              public=True, archivable=True, created=now)
+                        for i in range(7)]
+        db.session.add_all(self.entries)
+        db.session.flush()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        self.context.pop()
+
+    def paginate(self, page_size):
+        seen = []
+        after = None
+        while True:
+            rows = query.search_entries(True, 'zyzzyva', page_size, after).all()
+            seen.extend(row.id for row in rows)
+            if len(rows) < page_size:
+                return seen
+            after = decode_search_cursor(encode_search_cursor(rows[-1]))
+
+    def test_tied_ranks_are_neither_repeated_nor_skipped(self):
+        expected = set(entry.id for entry in self.entries)
+        for page_size in [1, 2, 3]:
+            seen = self.paginate(page_size)
+            self.assertEqual(len(seen), len(set(seen)))
+            self.assertEqual(set(seen), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()